@@ -86,6 +86,8 @@ class MuseFlow(L.LightningFlow):
         self.fake_trigger = 0
         self.gpu_type = gpu_type
         self._last_autoscale = time.time()
+        # the workers warm up at the smallest and the largest batch the load balancer sends
+        self._warmup_batch_sizes = sorted({1, max_batch_size})
 
         # Create Drive to store Safety Checker embeddings
         self.safety_embeddings_drive = Drive("lit://embeddings")
@@ -101,6 +103,7 @@ class MuseFlow(L.LightningFlow):
                 safety_embeddings_drive=self.safety_embeddings_drive,
                 safety_embeddings_filename=self.safety_checker_embedding_work.safety_embeddings_filename,
                 cloud_compute=L.CloudCompute(gpu_type, disk_size=30),
+                warmup_batch_sizes=self._warmup_batch_sizes,
                 cache_calls=True,
                 parallel=True,
                 start_with_flow=False,
@@ -220,6 +223,7 @@ class MuseFlow(L.LightningFlow):
                 safety_embeddings_drive=self.safety_embeddings_drive,
                 safety_embeddings_filename=self.safety_checker_embedding_work.safety_embeddings_filename,
                 cloud_compute=L.CloudCompute(self.gpu_type, disk_size=30),
+                warmup_batch_sizes=self._warmup_batch_sizes,
                 cache_calls=True,
                 parallel=True,
             )
@@ -5,12 +5,27 @@ ENABLE_ANALYTICS = bool(int(os.environ.get("MUSE_ENABLE_ANALYTICS", 0)))
 MUSE_LOAD_TESTING = os.environ.get("MUSE_LOAD_TESTING", False)
 MUSE_MIN_WORKERS = int(os.environ.get("MUSE_MIN_WORKERS", 1))
 MUSE_GPU_TYPE = os.environ.get("MUSE_GPU_TYPE", "gpu")
-INFERENCE_REQUEST_TIMEOUT = os.environ.get("INFERENCE_REQUEST_TIMEOUT", 160)
-KEEP_ALIVE_TIMEOUT = os.environ.get("KEEP_ALIVE_TIMEOUT", 160)
+INFERENCE_REQUEST_TIMEOUT = int(os.environ.get("INFERENCE_REQUEST_TIMEOUT", 160))
+KEEP_ALIVE_TIMEOUT = int(os.environ.get("KEEP_ALIVE_TIMEOUT", 160))
 RATE_LIMIT_KEY = os.environ.get("RATE_LIMIT_KEY", str(uuid.uuid4().hex))
 SENTRY_API_KEY = os.environ.get("SENTRY_API_KEY", None)
 MUSE_SYSTEM_PASSWORD = os.environ.get("MUSE_SYSTEM_PASSWORD", "")
 IMAGE_SIZE = 512  # 512 or 768
+IMAGE_FORMATS = {"png": "image/png", "webp": "image/webp"}  # {image format: media type}
+# weights of the in-repo pipeline (muse.pipeline), used by the step-level serving modes of StableDiffusionServe
+DEFAULT_SD_CHECKPOINT_URL = "https://pl-public-data.s3.amazonaws.com/dream_stable_diffusion/v1-5-pruned-emaonly.ckpt"
+DEFAULT_SD_CHECKPOINT_SHA256 = "cc6cb27103417325ff94f52b7a5d2dde45a7515b25c255d8e396c90014281516"
+SD_CHECKPOINT_URL = os.environ.get("SD_CHECKPOINT_URL", DEFAULT_SD_CHECKPOINT_URL)
+SD_CONFIG_URL = os.environ.get(
+    "SD_CONFIG_URL",
+    "https://raw.githubusercontent.com/CompVis/stable-diffusion/main/configs/stable-diffusion/v1-inference.yaml",
+)
+# the known checksum only holds for the default checkpoint, an empty value disables the check
+SD_CHECKPOINT_SHA256 = os.environ.get(
+    "SD_CHECKPOINT_SHA256", DEFAULT_SD_CHECKPOINT_SHA256 if SD_CHECKPOINT_URL == DEFAULT_SD_CHECKPOINT_URL else ""
+)
+# downloaded weights, shared by the workers running on the same node
+MUSE_WEIGHTS_CACHE = os.environ.get("MUSE_WEIGHTS_CACHE", os.path.expanduser("~/.cache/muse/weights"))
 
 NSFW_PROMPTS = [
     "nudity",
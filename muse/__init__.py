@@ -1,10 +1,23 @@
+import importlib
+from typing import TYPE_CHECKING, Any
+
 from muse.__about__ import *  # noqa: F401, F403
-from muse.components import (
-    LoadBalancer,
-    Locust,
-    MuseSlackCommandBot,
-    SafetyCheckerEmbedding,
-    StableDiffusionServe,
-)
+
+if TYPE_CHECKING:
+    from muse.components import (  # noqa: F401
+        LoadBalancer,
+        Locust,
+        MuseSlackCommandBot,
+        SafetyCheckerEmbedding,
+        StableDiffusionServe,
+    )
 
 __all__ = ["MuseSlackCommandBot", "StableDiffusionServe", "LoadBalancer", "Locust", "SafetyCheckerEmbedding"]
+
+
+def __getattr__(name: str) -> Any:
+    # the components import torch and lightning, they are loaded on first use so that the processes importing a
+    # single utility module, like the image encoding workers, do not pay for them
+    if name in __all__:
+        return getattr(importlib.import_module("muse.components"), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,12 +1,13 @@
 import asyncio
 import logging
+import math
 import secrets
 import time
 import uuid
 from base64 import b64encode
+from collections import defaultdict, deque
 from dataclasses import dataclass
-from itertools import cycle
-from typing import List
+from typing import AsyncIterator, List, Optional
 
 import aiohttp
 import lightning as L
@@ -14,6 +15,7 @@ import requests
 import sentry_sdk
 from fastapi import HTTPException
 from fastapi.requests import Request
+from fastapi.responses import Response, StreamingResponse
 from ratelimit import RateLimitMiddleware
 from ratelimit.backends.simple import MemoryBackend
 from starlette.status import HTTP_401_UNAUTHORIZED
@@ -24,9 +26,34 @@ from muse.CONST import (
     MUSE_SYSTEM_PASSWORD,
     SENTRY_API_KEY,
 )
-from muse.utility.data_io import Data, SysInfo, TimeoutException, random_prompt
-from muse.utility.exception_handling import raise_granular_exception
+from muse.utility.data_io import (
+    IMAGE_FORMATS,
+    Data,
+    LimitBacklogException,
+    SysInfo,
+    TimeoutException,
+    batch_key,
+    decode_data_uri,
+    inference_steps,
+    negotiate_image_format,
+    normalize_prompt,
+    random_prompt,
+    request_quality,
+)
+from muse.utility.exception_handling import (
+    is_server_failure,
+    raise_granular_exception,
+    worker_error_detail,
+)
+from muse.utility.metrics import (
+    BATCH_HEDGES,
+    BATCH_RETRIES,
+    COALESCE_HITS,
+    COALESCE_LOOKUPS,
+)
 from muse.utility.rate_limiter import RULES, auth_function
+from muse.utility.result_cache import ResultCache, cache_key
+from muse.utility.routing import NoServerAvailable, Router
 
 
 @dataclass
@@ -36,7 +63,12 @@ class FastAPIBuildConfig(L.BuildConfig):
 
 class LoadBalancer(L.LightningWork):
     r"""The LoadBalancer is a LightningWork component that collects the requests and sends it to the prediciton API
-    asynchronously using RoundRobin scheduling. It also performs auto batching of the incoming requests.
+    asynchronously. It also performs auto batching of the incoming requests, only requests with the same sampler and
+    number of steps are batched together.
+
+    Each batch is routed to a server chosen by the routing policy. The default ``expected_completion`` policy tracks the
+    batches in flight and an EWMA of the batch latency per server and quality, and picks the server expected to finish
+    the batch first. ``least_outstanding`` and ``round_robin`` are also available.
 
     The LoadBalancer exposes system endpoints with a basic HTTP authentication, in order to activate the authentication
     you need to provide a system password from environment variable
@@ -45,80 +77,390 @@ class LoadBalancer(L.LightningWork):
 
     Args:
         max_batch_size: Number of requests processed at once.
-        batch_timeout_secs: Number of seconds to wait before sending the requests to process.
+        batch_timeout_secs: Maximum number of seconds a request waits in its queue before a partial batch is sent.
+        max_connections_per_server: Size of the keep-alive connection pool kept open to each model server.
+        routing_policy: Name of the policy used to pick a server for each batch, one of ``expected_completion``,
+            ``least_outstanding`` or ``round_robin``.
+        health_check_interval: Number of seconds between two probes of the ``/api/ready`` endpoint of each server.
+            Batches are only routed to the servers whose probe reported them as ready, after their warmup.
+        health_check_timeout: Number of seconds after which a probe counts as failed.
+        failure_threshold: Consecutive failed probes or batches after which a server is ejected. An ejected server is
+            re-admitted once a trial batch succeeds after its ejection period.
+        coalesce_requests: Whether requests with the same prompt and quality share the generation of a request that is
+            still queued or in flight, instead of being generated again.
+        result_cache_bytes: Size in bytes of the in-memory cache of generated results. Repeated requests with the same
+            prompt and quality are answered from the cache. Disabled when ``0``.
+        result_cache_dir: Directory of the on-disk tier of the result cache, used when the memory tier is enabled.
+        result_cache_disk_bytes: Size in bytes of the on-disk tier of the result cache.
+        max_retries: Number of times a batch that failed because of its server is re-sent to another server.
+        hedge_latency_factor: When set, a batch still running after this many times the average batch latency of its
+            quality is also sent to another server, and the first result is used. Disabled by default.
+        max_queue_size: Maximum number of requests waiting to be batched, further requests are rejected with a 503.
+            Requests are also rejected when the estimated wait exceeds ``INFERENCE_REQUEST_TIMEOUT``.
         \**kwargs: Arguments passed to :func:`LightningWork.init` like ``CloudCompute``, ``BuildConfig``, etc.
     """
 
-    def __init__(self, max_batch_size=8, batch_timeout_secs=10, **kwargs):
+    def __init__(
+        self,
+        max_batch_size=8,
+        batch_timeout_secs=10,
+        max_connections_per_server=32,
+        routing_policy="expected_completion",
+        health_check_interval=5,
+        health_check_timeout=5,
+        failure_threshold=3,
+        coalesce_requests=True,
+        result_cache_bytes=0,
+        result_cache_dir=None,
+        result_cache_disk_bytes=0,
+        max_retries=2,
+        hedge_latency_factor=None,
+        max_queue_size=None,
+        **kwargs,
+    ):
         super().__init__(cloud_compute=L.CloudCompute("cpu-medium"), cloud_build_config=FastAPIBuildConfig(), **kwargs)
         self._server_ready = False
         self.servers = []
         self.max_batch_size = max_batch_size
         self.batch_timeout_secs = batch_timeout_secs
-        self._ITER = None
-        self._batch = {"high": [], "low": []}
-        self._responses = {}  # {request_id: response}
-        self._last_batch_sent = 0
+        self.max_connections_per_server = max_connections_per_server
+        self.routing_policy = routing_policy
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.failure_threshold = failure_threshold
+        self.coalesce_requests = coalesce_requests
+        self.result_cache_bytes = result_cache_bytes
+        self.result_cache_dir = result_cache_dir
+        self.result_cache_disk_bytes = result_cache_disk_bytes
+        self.max_retries = max_retries
+        self.hedge_latency_factor = hedge_latency_factor
+        self.max_queue_size = max_queue_size
+        self._router = Router(routing_policy, failure_threshold=failure_threshold)
+        self._batch = defaultdict(deque)  # {batch_key: deque((request_id, data, enqueue_time))}
+        self._responses = {}  # {request_id: asyncio.Future}
+        self._coalesced = {}  # {(normalized prompt, image_format, sampler, steps): asyncio.Future}
+        self._result_cache: Optional[ResultCache] = None
+        self._batch_event: Optional[asyncio.Event] = None
+        self._sessions = {}  # {server: aiohttp.ClientSession}
 
         self.ready = False
 
     async def send_batch(self, batch):
-        server = next(self._ITER)
+        """Sends a batch to a server and resolves its requests.
+
+        A batch that fails because of the server is re-sent to a server it was not sent to yet, up to ``max_retries``
+        times and as long as the deadline of its oldest request allows.
+        """
+        quality = request_quality(Data(**batch[0][1]))
         data = {"batch": [b[1] for b in batch]}
+        deadline = batch[0][2] + INFERENCE_REQUEST_TIMEOUT
+        tried_servers = []
+        error = None
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                BATCH_RETRIES.labels(quality).inc()
+            if time.monotonic() >= deadline:
+                error = TimeoutException()
+                break
+            try:
+                result = await self._dispatch(quality, data, tried_servers, deadline)
+                for request, r in zip(batch, result):
+                    self._set_response(request[0], r)
+                return
+            except NoServerAvailable as e:
+                # every server was tried or is ejected, report the last server error if there was one
+                error = error or e
+                break
+            except Exception as e:
+                error = e
+                if not is_server_failure(e):
+                    break
+
+        for request in batch:
+            self._set_response(request[0], error)
+
+    async def _dispatch(self, quality: str, data: dict, tried_servers: List[str], deadline: float) -> list:
+        """Sends a batch to the server picked by the router.
+
+        When hedging is enabled and the batch takes longer than ``hedge_latency_factor`` times the average batch
+        latency of its quality, it is also sent to another server. The first result wins and the other request is
+        cancelled.
+        """
+        server = self._router.acquire(quality, exclude=tried_servers)
+        tried_servers.append(server)
+        first = asyncio.create_task(self._attempt(server, quality, data, deadline))
+        if self.hedge_latency_factor is None:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_latency_factor * self._router.fleet_latency(quality))
+        if done:
+            return first.result()
+        try:
+            hedge_server = self._router.acquire(quality, exclude=tried_servers)
+        except NoServerAvailable:
+            return await first
+        tried_servers.append(hedge_server)
+        BATCH_HEDGES.labels(quality).inc()
 
+        pending = {first, asyncio.create_task(self._attempt(hedge_server, quality, data, deadline))}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _attempt(self, server: str, quality: str, data: dict, deadline: float) -> list:
+        latency = None
+        failed = False
+        start_time = time.monotonic()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{server}/api/predict", json=data, timeout=INFERENCE_REQUEST_TIMEOUT
-                ) as result:
-                    if result.status == 408:
-                        raise TimeoutException()
-                    result.raise_for_status()
-                    result = await result.json()
-                    result = {request[0]: r for request, r in zip(batch, result)}
-                    self._responses.update(result)
+            result = await self._post_batch(server, data, timeout=max(deadline - start_time, 0))
+            latency = time.monotonic() - start_time
+            return result
         except Exception as e:
-            result = {request[0]: e for request in batch}
-            self._responses.update(result)
-
-    async def consumer(self):
+            failed = is_server_failure(e)
+            raise
+        finally:
+            self._router.release(server, quality, latency=latency, failed=failed)
+
+    async def _post_batch(self, server: str, data: dict, timeout: float) -> list:
+        session = self._get_session(server)
+        async with session.post(
+            f"{server}/api/predict", json=data, timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as result:
+            if result.status == 408:
+                raise TimeoutException()
+            if 400 <= result.status < 500:
+                # the server rejected the batch, for example a sampler it does not support, the clients get its reason
+                raise HTTPException(result.status, await worker_error_detail(result))
+            result.raise_for_status()
+            return await result.json()
+
+    def _get_session(self, server: str) -> aiohttp.ClientSession:
+        """Returns the long-lived session of a server, creating its connection pool on first use.
+
+        Idle connections are closed by the client a little before the model server's ``timeout_keep_alive`` expires,
+        so a pooled connection is never reused while the server is closing it.
+        """
+        session = self._sessions.get(server)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections_per_server,
+                limit_per_host=self.max_connections_per_server,
+                keepalive_timeout=max(KEEP_ALIVE_TIMEOUT - 5, 1),
+            )
+            session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=INFERENCE_REQUEST_TIMEOUT)
+            )
+            self._sessions[server] = session
+        return session
+
+    async def _close_sessions(self, servers: List[str]):
+        for server in servers:
+            session = self._sessions.pop(server, None)
+            if session is not None:
+                await session.close()
+
+    async def probe_servers(self):
+        """Probes the ``/api/ready`` endpoint of every server and reports the results to the router.
+
+        A ``503`` comes from a server that is still warming up, it is healthy but not ready yet.
+        """
+
+        async def probe(server: str):
+            ready = None
+            try:
+                session = self._get_session(server)
+                timeout = aiohttp.ClientTimeout(total=self.health_check_timeout)
+                async with session.get(f"{server}/api/ready", timeout=timeout) as response:
+                    healthy = response.status in (200, 503)
+                    if healthy:
+                        ready = response.status == 200
+            except Exception:
+                healthy = False
+            self._router.record_probe(server, healthy, ready=ready)
+
+        await asyncio.gather(*[probe(server) for server in list(self._router.servers)])
+
+    async def health_checker(self):
         while True:
-            await asyncio.sleep(0.1)
+            await self.probe_servers()
+            await asyncio.sleep(self.health_check_interval)
 
-            has_sent = False
+    def _set_response(self, request_id: str, response):
+        """Resolves the future a request is waiting on, if the request is still waiting for it."""
+        future = self._responses.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(response)
 
-            for quality in self._batch.keys():
-                batch = self._batch[quality][: self.max_batch_size]
-                while batch and (
-                    (len(batch) >= self.max_batch_size)
-                    or ((time.time() - self._last_batch_sent) > self.batch_timeout_secs)  # noqa: W503
-                ):
-                    has_sent = True
+    async def consumer(self):
+        """Sends a batch as soon as its queue holds ``max_batch_size`` requests or its oldest request has waited
+        ``batch_timeout_secs``.
 
-                    asyncio.create_task(self.send_batch(batch))
+        Each queue keeps its own deadline, and the consumer sleeps until either the next deadline or a new
+        request arrives.
+        """
+        self._batch_event = asyncio.Event()
+        while True:
+            next_deadline = None
+            now = time.monotonic()
 
-                    self._batch[quality] = self._batch[quality][self.max_batch_size :]
-                    batch = self._batch[quality][: self.max_batch_size]
+            for queue in self._batch.values():
+                while len(queue) >= self.max_batch_size or (queue and now - queue[0][2] >= self.batch_timeout_secs):
+                    batch = [queue.popleft() for _ in range(min(self.max_batch_size, len(queue)))]
+                    asyncio.create_task(self.send_batch(batch))
 
-            if has_sent:
-                self._last_batch_sent = time.time()
+                if queue:
+                    deadline = queue[0][2] + self.batch_timeout_secs
+                    next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+
+            self._batch_event.clear()
+            timeout = None if next_deadline is None else max(next_deadline - now, 0)
+            try:
+                await asyncio.wait_for(self._batch_event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def admit_request(self, data: Data):
+        """Rejects a request right away when it cannot be answered before ``INFERENCE_REQUEST_TIMEOUT``.
+
+        The wait is estimated from the queued requests, the batches in flight and the measured batch latency of the
+        available servers. The ``Retry-After`` header tells the client when enough of that backlog should be gone.
+        """
+        quality = request_quality(data)
+        queued_batches = {}
+        for (queue_quality, _, _), queue in self._batch.items():
+            queued_batches[queue_quality] = queued_batches.get(queue_quality, 0) + math.ceil(
+                len(queue) / self.max_batch_size
+            )
+        estimated_wait = self._router.estimate_wait(quality, queued_batches)
+        retry_after = max(estimated_wait - INFERENCE_REQUEST_TIMEOUT, 1)
+
+        if self.max_queue_size is not None and sum(len(queue) for queue in self._batch.values()) >= self.max_queue_size:
+            raise LimitBacklogException(retry_after=retry_after)
+        if estimated_wait > INFERENCE_REQUEST_TIMEOUT:
+            raise LimitBacklogException(retry_after=retry_after)
+
+    def check_servers(self):
+        """Rejects a request when no server can take it. While the servers are warming up the ``503`` tells the
+        client to retry after the next readiness probe."""
+        if self.servers and not self._router.available_servers() and self._router.warming_servers:
+            raise LimitBacklogException(detail="The workers are warming up.", retry_after=self.health_check_interval)
+        if not self.servers or not self._router.available_servers():
+            raise HTTPException(500, "None of the workers are healthy!")
 
     async def process_request(self, data: Data):
-        if not self.servers:
-            raise HTTPException(500, "None of the workers are healthy!")
+        self.check_servers()
 
-        request_id = uuid.uuid4().hex
-        request = (request_id, data.dict())
-        self._batch["high" if data.high_quality else "low"].append(request)
+        if self._result_cache is not None:
+            result_key = cache_key(data)
+            result = await self._run_cache(self._result_cache.get, result_key)
+            if result is not None:
+                return result
 
-        while True:
-            await asyncio.sleep(0.2)
+        key = (normalize_prompt(data.prompt), data.image_format, data.sampler, inference_steps(data))
+        if self.coalesce_requests:
+            COALESCE_LOOKUPS.inc()
+        if self.coalesce_requests and key in self._coalesced:
+            # an identical prompt is already queued or in flight, its generation answers this request too
+            COALESCE_HITS.inc()
+            future = self._coalesced[key]
+        else:
+            self.admit_request(data)
+            future = self._enqueue(data)
+            if self._result_cache is not None:
+                future.add_done_callback(lambda f: self._cache_result(result_key, f.result()))
+            if self.coalesce_requests:
+                self._coalesced[key] = future
+                future.add_done_callback(lambda _: self._coalesced.pop(key, None))
+
+        # shielded so that a client going away does not cancel the generation other requests may be waiting for
+        result = await asyncio.shield(future)
+        raise_granular_exception(result)
+        return result
+
+    async def stream_request(self, data: Data, preview_steps: int) -> AsyncIterator[bytes]:
+        """Opens a stream of previews of a prompt on the server picked by the router and returns its server-sent
+        events as they arrive.
+
+        The request is not batched. Closing the returned iterator, for example when the client goes away, closes the
+        connection to the server, which stops the generation.
+        """
+        self.check_servers()
+        quality = request_quality(data)
+        try:
+            server = self._router.acquire(quality)
+        except NoServerAvailable as e:
+            raise HTTPException(500, str(e))
 
-            if request_id in self._responses:
-                result = self._responses[request_id]
-                del self._responses[request_id]
-                raise_granular_exception(result)
-                return result
+        try:
+            response = await self._open_stream(server, data, preview_steps)
+        except Exception as e:
+            self._router.release(server, quality, failed=is_server_failure(e))
+            raise
+
+        async def events():
+            failed = False
+            try:
+                async for chunk in response.content.iter_any():
+                    yield chunk
+            except Exception as e:
+                failed = is_server_failure(e)
+                raise
+            finally:
+                response.close()
+                # a stream holds a single prompt, its duration is not a batch latency
+                self._router.release(server, quality, failed=failed)
+
+        return events()
+
+    async def _open_stream(self, server: str, data: Data, preview_steps: int) -> aiohttp.ClientResponse:
+        """Starts the stream of a prompt on a server.
+
+        A server rejecting the stream or failing to start it answers with an error status, which is raised as an
+        ``HTTPException`` with the detail given by the server once the response is closed.
+        """
+        response = await self._get_session(server).post(
+            f"{server}/api/stream",
+            params={"preview_steps": preview_steps},
+            json=data.dict(),
+            timeout=aiohttp.ClientTimeout(total=INFERENCE_REQUEST_TIMEOUT),
+        )
+        if response.status < 400:
+            return response
+        try:
+            detail = await worker_error_detail(response)
+        finally:
+            response.close()
+        raise HTTPException(response.status, detail)
+
+    def _cache_result(self, key: str, result):
+        if isinstance(result, dict):
+            asyncio.ensure_future(self._run_cache(self._result_cache.put, key, result))
+
+    async def _run_cache(self, fn, *args):
+        """Runs a cache operation, in a thread when it may read or write the disk tier."""
+        if self._result_cache.disk is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def _enqueue(self, data: Data) -> asyncio.Future:
+        """Queues a request for batching and returns the future ``send_batch`` resolves with its result."""
+        request_id = uuid.uuid4().hex
+        request = (request_id, data.dict(), time.monotonic())
+        future = asyncio.get_running_loop().create_future()
+        self._responses[request_id] = future
+        self._batch[batch_key(data)].append(request)
+        if self._batch_event is not None:
+            self._batch_event.set()
+        return future
 
     def run(self, servers: List[str]):
         if self._server_ready or not servers:
@@ -137,8 +479,11 @@ class LoadBalancer(L.LightningWork):
 
         print(self.servers)
 
-        self._ITER = cycle(self.servers)
-        self._last_batch_sent = time.time()
+        self._router.update_servers(self.servers, ready=False)
+        if self.result_cache_bytes:
+            self._result_cache = ResultCache(
+                self.result_cache_bytes, disk_path=self.result_cache_dir, disk_bytes=self.result_cache_disk_bytes
+            )
 
         app = FastAPI()
         security = HTTPBasic()
@@ -157,6 +502,7 @@ class LoadBalancer(L.LightningWork):
         app.num_current_requests = 0
         app.last_process_time = 0
         app.SEND_TASK = None
+        app.HEALTH_CHECK_TASK = None
 
         @app.middleware("http")
         async def current_request_counter(request: Request, call_next):
@@ -188,17 +534,21 @@ class LoadBalancer(L.LightningWork):
             backend=MemoryBackend(),
             config={
                 r"^/api/predict": RULES,
+                r"^/api/stream": RULES,
             },
         )
 
         @app.on_event("startup")
         async def startup_event():
             app.SEND_TASK = asyncio.create_task(self.consumer())
+            app.HEALTH_CHECK_TASK = asyncio.create_task(self.health_checker())
             self._server_ready = True
 
         @app.on_event("shutdown")
-        def shutdown_event():
+        async def shutdown_event():
             app.SEND_TASK.cancel()
+            app.HEALTH_CHECK_TASK.cancel()
+            await self._close_sessions(list(self._sessions))
             self._server_ready = False
 
         def authenticate_private_endpoint(credentials: HTTPBasicCredentials = Depends(security)):
@@ -219,6 +569,8 @@ class LoadBalancer(L.LightningWork):
             return SysInfo(
                 num_workers=len(self.servers),
                 servers=self.servers,
+                ejected_servers=self._router.ejected_servers,
+                warming_servers=self._router.warming_servers,
                 num_requests=app.num_current_requests,
                 process_time=app.last_process_time,
                 global_request_count=app.global_request_count,
@@ -230,8 +582,10 @@ class LoadBalancer(L.LightningWork):
 
         @app.put("/system/update-servers")
         async def update_servers(servers: List[str], authenticated: bool = Depends(authenticate_private_endpoint)):
+            removed_servers = set(self.servers) - set(servers)
             self.servers = servers
-            self._ITER = cycle(self.servers)
+            self._router.update_servers(self.servers, ready=False)
+            await self._close_sessions([server for server in self._sessions if server in removed_servers])
 
         @app.post("/api/surprise-me")
         async def surprise_me():
@@ -239,10 +593,37 @@ class LoadBalancer(L.LightningWork):
             return await self.process_request(data)
 
         @app.post("/api/predict")
-        async def balance_api(data: Data, x_api_key: str = Header(default=None)):
+        async def balance_api(
+            data: Data, x_api_key: str = Header(default=None), accept: Optional[str] = Header(default=None)
+        ):
+            """Generates an image for the prompt.
+
+            The image is returned as a base64 data URI in JSON, or as raw image bytes when the ``Accept`` header prefers
+            ``image/png`` or ``image/webp``.
+            """
             if data.prompt.lower() == "surprise me":
                 data.prompt = random_prompt()
-            return await self.process_request(data)
+            image_format = negotiate_image_format(accept)
+            if image_format is None:
+                return await self.process_request(data)
+
+            data.image_format = image_format
+            result = await self.process_request(data)
+            return Response(content=decode_data_uri(result["image"]), media_type=IMAGE_FORMATS[image_format])
+
+        @app.post("/api/stream")
+        async def stream_api(data: Data, preview_steps: int = 5, x_api_key: str = Header(default=None)):
+            """Streams the generation of a prompt as server-sent events: ``preview`` events with a low resolution
+            approximation of the image every ``preview_steps`` denoising steps, then a ``result`` or an ``error``
+            event.
+
+            Streamed requests are not batched, cached or coalesced, and the generation stops when the client
+            disconnects.
+            """
+            if data.prompt.lower() == "surprise me":
+                data.prompt = random_prompt()
+            events = await self.stream_request(data, preview_steps)
+            return StreamingResponse(events, media_type="text/event-stream")
 
         self.ready = True
 
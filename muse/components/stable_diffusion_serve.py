@@ -1,19 +1,20 @@
-import base64
+import asyncio
 import os
 import os.path
-import tarfile
+import shutil
+import threading
 import time
-import urllib.request
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from dataclasses import dataclass
-from io import BytesIO
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 
 import lightning as L  # noqa: E402
+import numpy as np  # noqa: E402
 import torch  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
 from lightning.app.storage import Drive  # noqa: E402
 from PIL import Image  # noqa: E402
 
@@ -21,25 +22,131 @@ from muse.CONST import (  # noqa: E402
     IMAGE_SIZE,
     INFERENCE_REQUEST_TIMEOUT,
     KEEP_ALIVE_TIMEOUT,
+    MUSE_WEIGHTS_CACHE,
+    SD_CHECKPOINT_SHA256,
+    SD_CHECKPOINT_URL,
+    SD_CONFIG_URL,
 )
-from muse.utility.data_io import Data, DataBatch, TimeoutException  # noqa: E402
+from muse.pipeline.model import timed, to_uint8  # noqa: E402
+from muse.pipeline.preview import latent_preview  # noqa: E402
+from muse.pipeline.sampling import SamplingCancelled  # noqa: E402
+from muse.pipeline.staged import StagedPipeline  # noqa: E402
+from muse.utility.data_io import (  # noqa: E402
+    Data,
+    DataBatch,
+    TimeoutException,
+    format_sse,
+    inference_steps,
+)
+from muse.utility.image_encoding import (  # noqa: E402
+    ImageEncoder,
+    encode_image,
+    to_data_uri,
+)
+from muse.utility.weights import WeightCache  # noqa: E402
+
+
+WARMUP_PROMPT = "a lighthouse on a cliff at sunset"
+
+
+def pil_to_tensor(images: List[Image.Image]) -> torch.Tensor:
+    """Converts PIL images into a tensor of shape ``(B, 3, H, W)`` with values in ``[0, 1]``."""
+    arrays = np.stack([np.asarray(image.convert("RGB")) for image in images])
+    return torch.from_numpy(arrays).permute(0, 3, 1, 2).float() / 255.0
+
+
+# normalization of the CLIP image encoder inputs
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def clip_preprocess(images: torch.Tensor, resolution: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Prepares images of shape ``(B, 3, H, W)`` with values in ``[0, 1]`` for a CLIP image encoder on ``device``, like
+    CLIP's own preprocessing: bicubic resize of the shortest side to ``resolution``, center crop and normalization."""
+    images = images.to(device, torch.float32)
+    height, width = images.shape[-2:]
+    scale = resolution / min(height, width)
+    size = (max(round(height * scale), resolution), max(round(width * scale), resolution))
+    images = torch.nn.functional.interpolate(images, size=size, mode="bicubic", align_corners=False, antialias=True)
+    top = (size[0] - resolution) // 2
+    left = (size[1] - resolution) // 2
+    images = images[:, :, top : top + resolution, left : left + resolution].clamp(0, 1)
+    mean = torch.tensor(CLIP_MEAN, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(CLIP_STD, device=device).view(1, 3, 1, 1)
+    return ((images - mean) / std).to(dtype)
 
 
 class SafetyChecker:
-    def __init__(self, embeddings_path):
+    """Flags the images, or the prompts, close to one of the NSFW text embeddings in the CLIP space.
+
+    Images are checked as a single batch of shape ``(B, 3, H, W)`` with values in ``[0, 1]``, preprocessed on the
+    device of the CLIP model, see :func:`clip_preprocess`.
+    """
+
+    def __init__(self, embeddings_path, device: str = "cpu"):
         import clip as openai_clip
 
-        self.model, self.preprocess = openai_clip.load("ViT-B/32", device="cpu")
-        self.text_embeddings = torch.load(embeddings_path)
+        self.device = torch.device(device)
+        self.model, _ = openai_clip.load("ViT-B/32", device=self.device)
+        self.resolution = self.model.visual.input_resolution
+        self.text_embeddings = torch.load(embeddings_path, map_location=self.device).to(self.model.dtype)
 
-    def __call__(self, images: List[Image.Image]):
-        images = torch.stack([self.preprocess(img) for img in images])
+    @torch.inference_mode()
+    def __call__(self, images: torch.Tensor) -> List[bool]:
+        images = clip_preprocess(images, self.resolution, self.device, self.model.dtype)
         encoded_images = self.model.encode_image(images)
 
         encoded_images = torch.nn.functional.normalize(encoded_images, p=2, dim=1)
         similarity = torch.mm(encoded_images, self.text_embeddings.transpose(0, 1))
         return torch.any(similarity > 0.3, dim=1).tolist()
 
+    @torch.inference_mode()
+    def check_prompts(self, prompts: List[str], threshold: float) -> List[bool]:
+        """Flags the prompts whose CLIP text embedding is closer than ``threshold`` to one of the NSFW embeddings."""
+        import clip as openai_clip
+
+        encoded_text = self.model.encode_text(openai_clip.tokenize(prompts, truncate=True).to(self.device))
+
+        encoded_text = torch.nn.functional.normalize(encoded_text, p=2, dim=1)
+        similarity = torch.mm(encoded_text, self.text_embeddings.transpose(0, 1))
+        return torch.any(similarity > threshold, dim=1).tolist()
+
+
+class PromptScreeningStats:
+    """Counts the prompts blocked before inference and estimates the GPU time saved, from the seconds per denoising
+    step of a sample observed on the batches that were generated."""
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.screened = 0
+        self.blocked = 0
+        self.blocked_steps = 0
+        self.secs_per_step: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def record_screening(self, steps: List[int], blocked: List[bool]):
+        with self._lock:
+            self.screened += len(blocked)
+            self.blocked += sum(blocked)
+            self.blocked_steps += sum(s for s, is_blocked in zip(steps, blocked) if is_blocked)
+
+    def observe_generation(self, num_steps: int, secs: float):
+        with self._lock:
+            secs_per_step = secs / num_steps
+            if self.secs_per_step is None:
+                self.secs_per_step = secs_per_step
+            else:
+                self.secs_per_step = self.alpha * secs_per_step + (1 - self.alpha) * self.secs_per_step
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "screened": self.screened,
+                "blocked": self.blocked,
+                "block_rate": self.blocked / self.screened if self.screened else 0.0,
+                "gpu_secs_saved": self.blocked_steps * (self.secs_per_step or 0.0),
+            }
+
 
 @dataclass
 class DiffusionBuildConfig(L.BuildConfig):
@@ -55,68 +162,404 @@ class StableDiffusionServe(L.LightningWork):
     """The StableDiffusionServer handles the prediction.
 
     It initializes a model and expose an API to handle incoming requests and generate predictions.
+
+    Args:
+        safety_embeddings_drive: Drive holding the embeddings of the safety checker.
+        safety_embeddings_filename: Name of the embeddings file in the drive.
+        continuous_batching: Serve with iteration-level batching. Requests join the running set of samples at the next
+            denoising step and leave it as soon as their own steps are done, instead of waiting for whole batches.
+            This mode loads the model from ``SD_CHECKPOINT_URL`` and ``SD_CONFIG_URL``.
+        max_running_samples: Maximum number of samples denoised together in continuous batching mode.
+        stage_queue_size: Maximum number of batches waiting between two stages of the pipeline, the generation of a
+            batch overlaps the safety check and encoding of the previous ones.
+        encode_processes: Number of processes encoding the generated images, ``0`` encodes in the server process.
+        png_compress_level: PNG compression level, from 0, fastest, to 9, smallest.
+        webp_quality: WebP quality, from 0 to 100.
+        prompt_safety_threshold: Prompts whose CLIP text embedding has a cosine similarity above this threshold with
+            one of the safety embeddings get the NSFW warning without being generated. Disabled by default: text-text
+            similarities run much higher than the image-text ones of the image check, so the threshold has to be
+            calibrated on benign prompts of the deployment before it is turned on.
+        warmup_batch_sizes: Sizes of the batches generated at every step count before ``/api/ready`` reports the
+            server as ready, so the first requests do not pay for CUDA context creation, cuDNN autotuning and the
+            first allocations. An empty list skips the warmup.
+        warmup_attempts: Number of times a failed warmup is run. The server reports itself unhealthy once the last
+            attempt failed.
+        cpu_precision: Enables the CPU serving mode on nodes without a GPU, one of ``fp32``, ``bf16`` or ``int8``.
+            The in-repo model is loaded from ``SD_CHECKPOINT_URL`` with its threads and memory format tuned for the
+            CPU, and runs under bf16 autocast or with its linear layers quantized to int8. Measure the speed and
+            quality of each precision on the target CPU with ``scripts/benchmark_cpu.py``.
+        cpu_threads: Number of threads of the CPU serving mode, all the CPUs available to the process by default.
     """
 
     def __init__(
-        self, safety_embeddings_drive: Optional[Drive] = None, safety_embeddings_filename: str = None, **kwargs
+        self,
+        safety_embeddings_drive: Optional[Drive] = None,
+        safety_embeddings_filename: str = None,
+        continuous_batching: bool = False,
+        max_running_samples: int = 12,
+        stage_queue_size: int = 2,
+        encode_processes: int = 4,
+        png_compress_level: int = 6,
+        webp_quality: int = 80,
+        prompt_safety_threshold: Optional[float] = None,
+        warmup_batch_sizes: Optional[List[int]] = None,
+        warmup_attempts: int = 3,
+        cpu_precision: Optional[str] = None,
+        cpu_threads: Optional[int] = None,
+        **kwargs,
     ):
         super().__init__(cloud_build_config=DiffusionBuildConfig(), **kwargs)
         self.safety_embeddings_drive = safety_embeddings_drive
         self.safety_embeddings_filename = safety_embeddings_filename
+        self.continuous_batching = continuous_batching
+        self.max_running_samples = max_running_samples
+        self.stage_queue_size = stage_queue_size
+        self.encode_processes = encode_processes
+        self.png_compress_level = png_compress_level
+        self.webp_quality = webp_quality
+        self.prompt_safety_threshold = prompt_safety_threshold
+        self.warmup_batch_sizes = [1] if warmup_batch_sizes is None else list(warmup_batch_sizes)
+        self.warmup_attempts = warmup_attempts
+        self.cpu_precision = cpu_precision
+        self.cpu_threads = cpu_threads
         self._model = None
         self._trainer = None
+        self._batcher = None
+        self._encoder = None
+        self._generate_pool: Optional[ThreadPoolExecutor] = None
+        self._screening = PromptScreeningStats()
+        self._startup_timings: Dict[str, float] = {}
+        self._warmup_timings: Dict[str, float] = {}
+        self._ready = threading.Event()
+        self._warmup_error: Optional[str] = None
+        self._warmup_failed = False
 
     @staticmethod
-    def download_weights(url: str, target_folder: Path):
+    def download_weights(url: str, target_folder: Path, sha256: Optional[str] = None) -> Path:
+        """Fetches weights through the weight cache of the node and links them into ``target_folder``, archives are
+        extracted there."""
         dest = target_folder / f"{os.path.basename(url)}"
         if not os.path.exists(dest):
             print("Downloading weights...")
-            urllib.request.urlretrieve(url, dest)
-            file = tarfile.open(dest)
-
-            # extracting file
-            file.extractall(target_folder)
+            blob = WeightCache(MUSE_WEIGHTS_CACHE).fetch(url, sha256=sha256, extract_to=target_folder)
+            try:
+                os.symlink(blob.resolve(), dest)
+            except OSError:
+                shutil.copyfile(blob, dest)
+        return dest
 
     def build_pipeline(self):
-        """The `build_pipeline(...)` method builds a model and trainer."""
-        from stable_diffusion_inference import create_text2image
+        """The `build_pipeline(...)` method builds a model and trainer.
 
+        The time spent in each phase of the startup is printed and kept in ``self._startup_timings``.
+        """
         print("loading model...")
-        # model url is loaded from stable_diffusion_inference library
-        # url: https://pl-public-data.s3.amazonaws.com/dream_stable_diffusion/v1-5-pruned-emaonly.ckpt
-        self._model = create_text2image(sd_variant=os.environ.get("SD_VARIANT", "sd1"))
-        self.safety_embeddings_drive.get(self.safety_embeddings_filename)
-        self._safety_checker = SafetyChecker(self.safety_embeddings_filename)
-        print("model loaded")
-
-    def predict(self, dreams: List[Data], entry_time: int):
-        if time.time() - entry_time > INFERENCE_REQUEST_TIMEOUT:
+        timings = self._startup_timings
+        if self.continuous_batching:
+            from muse.pipeline import ContinuousBatcher
+
+            self._model = self.load_model(timings)
+            self._batcher = ContinuousBatcher(
+                self._model, max_running=self.max_running_samples, height=IMAGE_SIZE, width=IMAGE_SIZE
+            )
+            self._batcher.start()
+        elif self.cpu_precision is not None and not torch.cuda.is_available():
+            self._model = self.load_model(timings)
+            self._generate_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+        else:
+            from stable_diffusion_inference import create_text2image
+
+            # model url is loaded from stable_diffusion_inference library
+            # url: https://pl-public-data.s3.amazonaws.com/dream_stable_diffusion/v1-5-pruned-emaonly.ckpt
+            with timed("load model", timings):
+                self._model = create_text2image(sd_variant=os.environ.get("SD_VARIANT", "sd1"))
+            self._generate_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+        with timed("safety model", timings):
+            self.safety_embeddings_drive.get(self.safety_embeddings_filename)
+            self._safety_checker = SafetyChecker(
+                self.safety_embeddings_filename, device="cuda" if torch.cuda.is_available() else "cpu"
+            )
+        self._encoder = ImageEncoder(self.encode_processes, self.png_compress_level, self.webp_quality)
+        print("model loaded,", ", ".join(f"{phase}: {secs:.2f}s" for phase, secs in timings.items()))
+
+    def load_model(self, timings: Optional[Dict[str, float]] = None):
+        """Loads the :class:`~muse.pipeline.StableDiffusionModel` used by the step-level and CPU serving modes.
+
+        A ``SD_CHECKPOINT_URL`` pointing to a ``.safetensors`` file is memory-mapped and loaded on the GPU directly.
+        """
+        from muse.pipeline import StableDiffusionModel
+
+        weights_folder = Path("weights")
+        weights_folder.mkdir(exist_ok=True)
+        with timed("download", timings):
+            config_path = self.download_weights(SD_CONFIG_URL, weights_folder)
+            weights_path = self.download_weights(SD_CHECKPOINT_URL, weights_folder, sha256=SD_CHECKPOINT_SHA256 or None)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        cpu_precision = self.cpu_precision if device == "cpu" else None
+        model = StableDiffusionModel(
+            device,
+            config_path,
+            weights_path,
+            timings=timings,
+            cpu_precision=cpu_precision,
+            num_threads=self.cpu_threads,
+        )
+        with timed("move to device", timings):
+            model = model.to(device).eval()
+            if device == "cuda":
+                torch.cuda.synchronize()
+        return model
+
+    def warmup(self) -> Dict[str, float]:
+        """Generates a batch of each size in ``warmup_batch_sizes`` at each step count through the whole pipeline and
+        returns the seconds taken by each batch.
+
+        The batches have no deadline, a slow cold start is not a timeout. The server is ready once the warmup is done.
+        A failed warmup is run again up to ``warmup_attempts`` times, after the last failure the server reports itself
+        unhealthy and the error is raised.
+        """
+        for attempt in range(1, self.warmup_attempts + 1):
+            try:
+                for batch_size in self.warmup_batch_sizes:
+                    for high_quality in (False, True):
+                        dreams = [Data(prompt=WARMUP_PROMPT, high_quality=high_quality) for _ in range(batch_size)]
+                        phase = f"batch of {batch_size} at {inference_steps(dreams[0])} steps"
+                        with timed(phase, self._warmup_timings):
+                            self.predict(dreams, entry_time=None)
+                break
+            except Exception as e:
+                self._warmup_timings = {}
+                self._warmup_error = f"warmup failed: {e!r}"
+                print(f"{self._warmup_error}, attempt {attempt} of {self.warmup_attempts}")
+                if attempt == self.warmup_attempts:
+                    self._warmup_failed = True
+                    raise
+        self._warmup_error = None
+        # the cold batches would skew the seconds per step of the prompt screening statistics
+        self._screening = PromptScreeningStats()
+        self._ready.set()
+        return self._warmup_timings
+
+    def validate(self, dreams: List[Data]):
+        """Rejects the requests the loaded model cannot generate, the ``text2image`` library only samples with DDIM."""
+        if self._batcher is not None or hasattr(self._model, "predict_step"):
+            return
+        unsupported = sorted({dream.sampler for dream in dreams} - {"ddim"})
+        if unsupported:
+            raise HTTPException(422, f"This server does not support the samplers {unsupported}, only 'ddim'.")
+
+    def predict(self, dreams: List[Data], entry_time: Optional[float], cancelled: Optional[threading.Event] = None):
+        return self.encode_images(self.check_safety(self.generate((dreams, entry_time, cancelled))))
+
+    def generate(
+        self, batch: Tuple[List[Data], Optional[float], Optional[threading.Event]]
+    ) -> Tuple[List[Data], Optional[torch.Tensor], List[bool]]:
+        """First stage of a batch, text conditioning, denoising and VAE decoding of its images into a tensor of shape
+        ``(B, 3, H, W)`` with values in ``[0, 1]``.
+
+        Prompts blocked by the prompt safety check are not generated, the tensor only holds the images of the other
+        prompts and is ``None`` when all of them are blocked. A batch whose request timed out or was cancelled while
+        it was queued is not generated either. A batch without ``entry_time`` has no deadline.
+        """
+        dreams, entry_time, cancelled = batch
+        deadline = None if entry_time is None else entry_time + INFERENCE_REQUEST_TIMEOUT
+        if (deadline is not None and time.time() > deadline) or (cancelled is not None and cancelled.is_set()):
             raise TimeoutException()
 
-        inference_steps = 50 if dreams[0].high_quality else 25
-
         prompts: List[str] = [dream.prompt for dream in dreams]
         print(prompts)
 
-        predictions = self._model(prompts, image_size=IMAGE_SIZE, inference_steps=inference_steps)
-        pil_results: List[Image.Image] = [predictions] if isinstance(predictions, Image.Image) else predictions
-
-        nsfw_content = self._safety_checker(pil_results)
-        for i, nsfw in enumerate(nsfw_content):
-            if nsfw:
-                pil_results[i] = Image.open("assets/nsfw-warning.png")
-
-        results = []
-        for image in pil_results:
-            buffered = BytesIO()
-            image.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            # make sure pil_results is a single item array or it'll rewrite image
-            results.append({"image": f"data:image/png;base64,{img_str}"})
+        blocked = self._screen_prompts(dreams)
+        kept = [dream for dream, is_blocked in zip(dreams, blocked) if not is_blocked]
+        if not kept:
+            return dreams, None, blocked
+
+        start_time = time.perf_counter()
+        if self._batcher is not None:
+            images = self._predict_continuous(kept, deadline, cancelled)
+        else:
+            images = self._on_generate_thread(self._predict_grouped, kept, deadline, cancelled)
+        self._screening.observe_generation(
+            sum(inference_steps(dream) for dream in kept), time.perf_counter() - start_time
+        )
+        return dreams, images, blocked
+
+    def check_safety(
+        self, batch: Tuple[List[Data], Optional[torch.Tensor], List[bool]]
+    ) -> Tuple[List[Data], List[Optional[np.ndarray]], List[bool]]:
+        """Second stage of a batch, flags its NSFW images and copies the images out of the device as ``uint8``
+        arrays."""
+        dreams, images, blocked = batch
+        nsfw_content = list(blocked)
+        arrays: List[Optional[np.ndarray]] = [None] * len(dreams)
+        if images is not None:
+            kept = [i for i, is_blocked in enumerate(blocked) if not is_blocked]
+            for i, nsfw, array in zip(kept, self._safety_checker(images), to_uint8(images)):
+                nsfw_content[i] = nsfw
+                arrays[i] = array
+        return dreams, arrays, nsfw_content
+
+    def _screen_prompts(self, dreams: List[Data]) -> List[bool]:
+        if self.prompt_safety_threshold is None:
+            return [False] * len(dreams)
+        blocked = self._safety_checker.check_prompts([dream.prompt for dream in dreams], self.prompt_safety_threshold)
+        self._screening.record_screening([inference_steps(dream) for dream in dreams], blocked)
+        return blocked
+
+    def encode_images(self, batch: Tuple[List[Data], List[Optional[np.ndarray]], List[bool]]) -> List[dict]:
+        """Last stage of a batch, encodes its images as data URIs in the encoder processes, the NSFW images are
+        replaced by the pre-encoded warning."""
+        dreams, images, nsfw_content = batch
+        image_formats = [dream.image_format for dream in dreams]
+        payloads = self._encoder.encode(images, image_formats, nsfw_content)
+        return [{"image": to_data_uri(payload, fmt)} for payload, fmt in zip(payloads, image_formats)]
+
+    def stream(
+        self,
+        dream: Data,
+        preview_steps: int,
+        emit: Callable[[str, dict], None],
+        cancelled: Optional[threading.Event] = None,
+    ):
+        """Generates the image of a single prompt and emits its progress.
+
+        A ``preview`` event is emitted every ``preview_steps`` denoising steps with a low resolution approximation of
+        the image, and a ``result`` event with the final image, or an ``error`` event. Generation stops at the next
+        step once ``cancelled`` is set. Previews need the in-repo model, the ``text2image`` library only emits the
+        result.
+        """
+        try:
+            blocked = self._screen_prompts([dream])
+            images = None
+            if not blocked[0]:
+                images = self._generate_with_previews(dream, preview_steps, emit, cancelled)
+            emit("result", self.encode_images(self.check_safety(([dream], images, blocked)))[0])
+        except SamplingCancelled:
+            pass
+        except Exception as e:
+            emit("error", {"detail": str(e)})
+
+    def _generate_with_previews(
+        self,
+        dream: Data,
+        preview_steps: int,
+        emit: Callable[[str, dict], None],
+        cancelled: Optional[threading.Event],
+    ) -> torch.Tensor:
+        steps = inference_steps(dream)
+
+        def on_step(step: int, pred_x0: torch.Tensor):
+            if cancelled is not None and cancelled.is_set():
+                raise SamplingCancelled()
+            if step % preview_steps == 0 and step < steps:
+                preview = to_uint8(latent_preview(pred_x0))[0]
+                payload = encode_image(preview, dream.image_format, compress_level=1)
+                emit("preview", {"step": step, "steps": steps, "image": to_data_uri(payload, dream.image_format)})
+
+        if self._batcher is not None:
+            return self._predict_continuous([dream], time.time() + INFERENCE_REQUEST_TIMEOUT, callback=on_step)
+        if not hasattr(self._model, "predict_step"):
+            return self._on_generate_thread(self._predict_grouped, [dream])
+        return self._on_generate_thread(
+            self._model.predict_step,
+            [dream.prompt],
+            0,
+            IMAGE_SIZE,
+            IMAGE_SIZE,
+            steps,
+            callback=on_step,
+            sampler=dream.sampler,
+            output_type="tensor",
+        )
 
-        return results
+    def _on_generate_thread(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Runs ``fn`` on the thread generating the batches, so batches and streams never use the model at the same
+        time. Runs it in the calling thread when the server has no such thread, like in continuous batching mode."""
+        if self._generate_pool is None:
+            return fn(*args, **kwargs)
+        return self._generate_pool.submit(fn, *args, **kwargs).result()
+
+    def _predict_grouped(
+        self, dreams: List[Data], deadline: Optional[float] = None, cancelled: Optional[threading.Event] = None
+    ) -> torch.Tensor:
+        """Runs the model once per sampler of the batch, so low quality requests are not run for 50 steps and high
+        quality ones not cut to 25.
+
+        The in-repo model denoises the samples of different step counts together, a mixed batch of 25 and 50 step
+        samples runs its first 25 steps over the whole batch and the last 25 over the high quality samples only. The
+        ``text2image`` library is run once per step count instead, the group with the fewest steps first.
+
+        Returns the images in the order of ``dreams``, see :meth:`generate`. The images of the in-repo model are
+        decoded into a tensor on its device directly, those of the library go through PIL.
+
+        The in-repo model stops at the next denoising step with :class:`~muse.pipeline.sampling.SamplingCancelled`
+        once ``time.time()`` passes ``deadline`` or ``cancelled`` is set, every request of the batch is gone then.
+        """
+
+        def on_step(step: int, pred_x0: torch.Tensor):
+            if (cancelled is not None and cancelled.is_set()) or (deadline is not None and time.time() > deadline):
+                raise SamplingCancelled()
+
+        mixed_steps = hasattr(self._model, "predict_step")
+        groups = {}  # {(sampler, inference_steps or None when mixed): [index in dreams]}
+        for i, dream in enumerate(dreams):
+            groups.setdefault((dream.sampler, None if mixed_steps else inference_steps(dream)), []).append(i)
+
+        images: List[Optional[torch.Tensor]] = [None] * len(dreams)
+        for sampler, steps in sorted(groups, key=lambda group: (group[1] or 0, group[0])):
+            indices = groups[(sampler, steps)]
+            prompts = [dreams[i].prompt for i in indices]
+            if mixed_steps:
+                predictions = self._model.predict_step(
+                    prompts,
+                    0,
+                    IMAGE_SIZE,
+                    IMAGE_SIZE,
+                    [inference_steps(dreams[i]) for i in indices],
+                    callback=on_step,
+                    sampler=sampler,
+                    output_type="tensor",
+                )
+            else:
+                pil_images = self._model(prompts, image_size=IMAGE_SIZE, inference_steps=steps)
+                predictions = pil_to_tensor([pil_images] if isinstance(pil_images, Image.Image) else pil_images)
+            for i, image in zip(indices, predictions):
+                images[i] = image
+        return torch.stack(images)
+
+    def _predict_continuous(
+        self,
+        dreams: List[Data],
+        deadline: Optional[float],
+        cancelled: Optional[threading.Event] = None,
+        callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+    ) -> torch.Tensor:
+        """Generates the images with the continuous batcher, the samples leave the running set at the next step once
+        ``time.time()`` passes ``deadline`` or ``cancelled`` is set. ``callback`` is called after every step of every
+        sample, see :meth:`~muse.pipeline.ContinuousBatcher.submit`."""
+        cancelled = cancelled or threading.Event()
+        futures = [
+            self._batcher.submit(
+                dream.prompt,
+                inference_steps(dream),
+                deadline=deadline,
+                cancelled=cancelled,
+                sampler=dream.sampler,
+                callback=callback,
+            )
+            for dream in dreams
+        ]
+        try:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            return torch.stack([future.result(timeout=timeout) for future in futures])
+        except BaseException as e:
+            # the other samples of the request are useless now
+            cancelled.set()
+            if isinstance(e, TimeoutError):
+                raise TimeoutException()
+            raise
 
-    def run(self):
+    def run(self):  # noqa: C901
 
         if False and self.safety_embeddings_filename not in self.safety_embeddings_drive.list("."):
             return
@@ -124,8 +567,9 @@ class StableDiffusionServe(L.LightningWork):
         import subprocess
 
         import uvicorn
-        from fastapi import FastAPI
+        from fastapi import FastAPI, Request
         from fastapi.middleware.cors import CORSMiddleware
+        from fastapi.responses import StreamingResponse
 
         if torch.cuda.is_available():
             subprocess.run("nvidia-smi", shell=True)
@@ -135,14 +579,38 @@ class StableDiffusionServe(L.LightningWork):
 
         self._fastapi_app = app = FastAPI()
         app.POOL: ThreadPoolExecutor = None
+        app.PIPELINE: StagedPipeline = None
+        app.STREAM_POOL: ThreadPoolExecutor = None
 
         @app.on_event("startup")
         def startup_event():
-            app.POOL = ThreadPoolExecutor(max_workers=1)
+            # streams generate on the generate thread or in the continuous batcher, like the batches
+            stream_workers = self.max_running_samples if self._batcher is not None else 1
+            app.STREAM_POOL = ThreadPoolExecutor(max_workers=stream_workers)
+            if self._batcher is not None:
+                # batches only wait on the continuous batcher, so they may overlap
+                app.POOL = ThreadPoolExecutor(max_workers=self.max_running_samples)
+            else:
+                # the model works on the next batch while the previous one is checked and encoded
+                app.PIPELINE = StagedPipeline(
+                    [("generate", self.generate), ("safety", self.check_safety), ("encode", self.encode_images)],
+                    queue_size=self.stage_queue_size,
+                )
+            # /api/health answers during the warmup, /api/ready only after it
+            threading.Thread(target=self.warmup, daemon=True).start()
 
         @app.on_event("shutdown")
         def shutdown_event():
-            app.POOL.shutdown(wait=False)
+            app.STREAM_POOL.shutdown(wait=False)
+            if app.POOL is not None:
+                app.POOL.shutdown(wait=False)
+            if app.PIPELINE is not None:
+                app.PIPELINE.stop()
+            if self._batcher is not None:
+                self._batcher.stop()
+            if self._generate_pool is not None:
+                self._generate_pool.shutdown(wait=False)
+            self._encoder.shutdown()
 
         app.add_middleware(
             CORSMiddleware,
@@ -154,26 +622,94 @@ class StableDiffusionServe(L.LightningWork):
 
         @app.get("/api/health")
         def health():
+            if self._warmup_failed:
+                raise HTTPException(500, self._warmup_error)
             return True
 
+        @app.get("/api/ready")
+        def ready():
+            """Answers once the warmup is done with the seconds spent in each phase of the startup and in each warmup
+            batch, with a 503 before and with a 500 once every warmup attempt failed."""
+            if self._warmup_failed:
+                raise HTTPException(500, self._warmup_error)
+            if not self._ready.is_set():
+                raise HTTPException(503, self._warmup_error or "warming up")
+            return {"startup": self._startup_timings, "warmup": self._warmup_timings}
+
+        @app.get("/api/stats")
+        def stats():
+            """Number of batches and seconds spent by each stage of the pipeline, the prompts blocked before inference,
+            the statistics of the conditioning cache of the in-repo model and the samples dropped by the continuous
+            batcher after their request was cancelled."""
+            result = {
+                "stages": app.PIPELINE.stats() if app.PIPELINE is not None else {},
+                "prompt_screening": self._screening.to_dict(),
+            }
+            conditioning = getattr(self._model, "conditioning", None)
+            if conditioning is not None:
+                result["conditioning_cache"] = conditioning.stats()
+            if self._batcher is not None:
+                result["cancelled_samples"] = self._batcher.cancelled_samples
+            return result
+
+        async def watch_disconnect(request: Request, cancelled: threading.Event):
+            while not await request.is_disconnected():
+                await asyncio.sleep(1)
+            cancelled.set()
+
         @app.post("/api/predict")
-        def predict_api(data: DataBatch):
+        async def predict_api(data: DataBatch, request: Request):
             """Dream a muse. Defines the REST API which takes the text prompt, number of images and image size in the
             request body.
 
-            This API returns an image generated by the model in base64 format.
+            This API returns an image generated by the model in base64 format. The batch is cancelled when it times out
+            or the load balancer disconnects, and its samples stop being denoised.
             """
+            self.validate(data.batch)
+            entry_time = time.time()
+            cancelled = threading.Event()
+            print(f"batch size: {len(data.batch)}")
+            if app.PIPELINE is not None:
+                future = app.PIPELINE.submit((data.batch, entry_time, cancelled))
+            else:
+                future = app.POOL.submit(self.predict, data.batch, entry_time, cancelled)
+            watcher = asyncio.create_task(watch_disconnect(request, cancelled))
             try:
-                entry_time = time.time()
-                print(f"batch size: {len(data.batch)}")
-                result = app.POOL.submit(
-                    self.predict,
-                    data.batch,
-                    entry_time=entry_time,
-                ).result(timeout=INFERENCE_REQUEST_TIMEOUT)
-                return result
-            except (TimeoutError, TimeoutException):
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout=INFERENCE_REQUEST_TIMEOUT)
+            except (asyncio.TimeoutError, TimeoutException, SamplingCancelled):
                 raise TimeoutException()
+            finally:
+                cancelled.set()
+                watcher.cancel()
+
+        @app.post("/api/stream")
+        async def stream_api(data: Data, preview_steps: int = 5):
+            """Streams the generation of a prompt as server-sent events, ``preview`` events every ``preview_steps``
+            denoising steps followed by a ``result`` or an ``error`` event.
+
+            Generation stops when the client disconnects.
+            """
+            self.validate([data])
+            loop = asyncio.get_running_loop()
+            events: asyncio.Queue = asyncio.Queue()
+            cancelled = threading.Event()
+
+            def emit(event: str, payload: dict):
+                loop.call_soon_threadsafe(events.put_nowait, (event, payload))
+
+            app.STREAM_POOL.submit(self.stream, data, max(preview_steps, 1), emit, cancelled)
+
+            async def event_stream():
+                try:
+                    while True:
+                        event, payload = await events.get()
+                        yield format_sse(event, payload)
+                        if event != "preview":
+                            return
+                finally:
+                    cancelled.set()
+
+            return StreamingResponse(event_stream(), media_type="text/event-stream")
 
         uvicorn.run(
             app, host=self.host, port=self.port, timeout_keep_alive=KEEP_ALIVE_TIMEOUT, access_log=False, loop="uvloop"
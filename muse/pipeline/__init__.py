@@ -1,4 +1,7 @@
+from .conditioning import ConditioningCache
+from .continuous import ContinuousBatcher
 from .data import ImageDataset
 from .model import StableDiffusionModel
+from .staged import StagedPipeline
 
-__all__ = ["ImageDataset", "StableDiffusionModel"]
+__all__ = ["ConditioningCache", "ContinuousBatcher", "ImageDataset", "StableDiffusionModel", "StagedPipeline"]
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+import torch
+
+
+class ConditioningCache:
+    """Caches the text conditioning of the latent diffusion model.
+
+    The unconditional embedding is encoded once per device and expanded to the batch sizes asked for. Prompt
+    embeddings are kept in an LRU bounded to ``max_prompts`` entries, and the prompts of a batch missing from it are
+    encoded together in a single call.
+
+    Args:
+        model: The latent diffusion model, its ``get_learned_conditioning`` encodes the prompts.
+        max_prompts: Maximum number of prompt embeddings kept.
+    """
+
+    def __init__(self, model: Any, max_prompts: int = 1024) -> None:
+        self.model = model
+        self.max_prompts = max_prompts
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._prompts: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._unconditional: Dict[Tuple[torch.device, int], torch.Tensor] = {}
+        self._lock = threading.Lock()
+
+    @torch.inference_mode()
+    def unconditional(self, batch_size: int) -> torch.Tensor:
+        """The embedding of the empty prompt, of shape ``(batch_size, 77, D)``."""
+        device = torch.device(self.model.device)
+        with self._lock:
+            key = (device, batch_size)
+            if key not in self._unconditional:
+                single = self._unconditional.get((device, 1))
+                if single is None:
+                    single = self._unconditional[(device, 1)] = self.model.get_learned_conditioning([""])
+                self._unconditional[key] = single.expand(batch_size, -1, -1)
+            return self._unconditional[key]
+
+    @torch.inference_mode()
+    def get(self, prompts: List[str]) -> torch.Tensor:
+        """The embeddings of the prompts, of shape ``(len(prompts), 77, D)``."""
+        with self._lock:
+            embeddings = {}
+            for prompt in prompts:
+                if prompt in self._prompts:
+                    self._prompts.move_to_end(prompt)
+                    embeddings[prompt] = self._prompts[prompt]
+            missing = list(dict.fromkeys(prompt for prompt in prompts if prompt not in embeddings))
+            num_missing = sum(prompt not in embeddings for prompt in prompts)
+            self.hits += len(prompts) - num_missing
+            self.misses += num_missing
+
+        if missing:
+            encoded = self.model.get_learned_conditioning(missing)
+            with self._lock:
+                for prompt, embedding in zip(missing, encoded):
+                    embeddings[prompt] = embedding
+                    # a view would keep the whole encoded batch alive as long as one of its prompts is cached
+                    self._prompts[prompt] = embedding.clone()
+                while len(self._prompts) > self.max_prompts:
+                    self._prompts.popitem(last=False)
+                    self.evictions += 1
+        return torch.stack([embeddings[prompt] for prompt in prompts])
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._prompts),
+            }
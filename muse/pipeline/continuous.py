@@ -0,0 +1,207 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from muse.pipeline.model import (
+    StableDiffusionModel,
+    downsampling_factor,
+    unconditional_guidance_scale,
+)
+from muse.pipeline.sampling import SamplingCancelled, ddim_timesteps, sampler_step
+
+
+class _Sample:
+    def __init__(
+        self,
+        prompt: str,
+        num_inference_steps: int,
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+        sampler: str = "ddim",
+        callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+    ) -> None:
+        self.prompt = prompt
+        self.sampler = sampler
+        self.callback = callback
+        self.history: Dict[str, Any] = {}
+        self.timesteps = ddim_timesteps(num_inference_steps)
+        self.position = 0
+        self.deadline = deadline
+        self.cancelled = cancelled
+        self.future: Future = Future()
+        # set when the sample joins the running set
+        self.cond: torch.Tensor
+        self.latent: torch.Tensor
+
+    @property
+    def done(self) -> bool:
+        return self.position == len(self.timesteps)
+
+    @property
+    def dead(self) -> bool:
+        """Whether nobody waits for the image anymore."""
+        if self.cancelled is not None and self.cancelled.is_set():
+            return True
+        return self.deadline is not None and time.time() > self.deadline
+
+
+class ContinuousBatcher:
+    """Iteration-level batching of the DDIM sampling loop.
+
+    A background thread keeps a running set of latents and runs one denoising step for all of them at a time. New
+    requests join the running set at the next step boundary, and every sample is decoded by the VAE and returned as
+    soon as its own schedule is finished, without waiting for the rest of the set. Images stay on the device of the
+    model, so they can be safety checked there before being copied out. Samples of different step counts share the
+    same UNet calls, and so do samples of different samplers.
+
+    Samples whose deadline passed or whose request was cancelled are dropped at the next step boundary, their future
+    fails with :class:`~muse.pipeline.sampling.SamplingCancelled` and their slot goes to a live request.
+
+    Args:
+        model: The model whose UNet, text encoder and VAE are used.
+        max_running: Maximum number of samples denoised together.
+        height: Height of the generated images.
+        width: Width of the generated images.
+    """
+
+    def __init__(self, model: StableDiffusionModel, max_running: int = 12, height: int = 512, width: int = 512) -> None:
+        self.model = model
+        self.max_running = max_running
+        self.latent_shape = (4, height // downsampling_factor, width // downsampling_factor)
+        self._waiting: "queue.Queue[_Sample]" = queue.Queue()
+        self._running: List[_Sample] = []
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.cancelled_samples = 0
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def submit(
+        self,
+        prompt: str,
+        num_inference_steps: int,
+        deadline: Optional[float] = None,
+        cancelled: Optional[threading.Event] = None,
+        sampler: str = "ddim",
+        callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+    ) -> Future:
+        """Queues a prompt, the future resolves to its image of shape ``(3, H, W)`` with values in ``[0, 1]``.
+
+        The sample is dropped once ``time.time()`` passes ``deadline`` or ``cancelled`` is set. ``callback`` is called
+        in the batcher thread after every step of the sample with the number of steps done and its predicted denoised
+        latents of shape ``(1, 4, H / 8, W / 8)``, the sample is dropped when it raises.
+        """
+        sample = _Sample(prompt, num_inference_steps, deadline, cancelled, sampler, callback)
+        self._waiting.put(sample)
+        return sample.future
+
+    def _loop(self) -> None:
+        with torch.inference_mode(), self.model.model.ema_scope(), self.model.autocast():
+            uncond = self.model.conditioning.unconditional(1)
+            while not self._stopped.is_set():
+                try:
+                    self._admit(block=not self._running)
+                    self._drop_dead()
+                    if self._running:
+                        self._step(uncond)
+                except Exception as e:
+                    for sample in self._running:
+                        if not sample.future.done():
+                            sample.future.set_exception(e)
+                    self._running = []
+
+    def _take_waiting(self, block: bool) -> List[_Sample]:
+        """Takes as many waiting samples as there are free slots, waiting briefly for one when ``block`` is set."""
+        samples = []
+        if block:
+            try:
+                samples.append(self._waiting.get(timeout=0.1))
+            except queue.Empty:
+                return samples
+        while len(self._running) + len(samples) < self.max_running:
+            try:
+                samples.append(self._waiting.get_nowait())
+            except queue.Empty:
+                break
+        return [sample for sample in samples if sample.future.set_running_or_notify_cancel()]
+
+    def _drop_dead(self) -> None:
+        running = []
+        for sample in self._running:
+            if sample.dead:
+                sample.future.set_exception(SamplingCancelled())
+                self.cancelled_samples += 1
+            else:
+                running.append(sample)
+        self._running = running
+
+    def _admit(self, block: bool) -> None:
+        samples = self._take_waiting(block)
+        if not samples:
+            return
+        try:
+            cond = self.model.conditioning.get([sample.prompt for sample in samples])
+            latents = torch.randn((len(samples), *self.latent_shape), device=cond.device)
+        except Exception as e:
+            for sample in samples:
+                sample.future.set_exception(e)
+            return
+        for sample, c, latent in zip(samples, cond, latents):
+            sample.cond = c
+            sample.latent = latent
+        self._running.extend(samples)
+
+    def _step(self, uncond: torch.Tensor) -> None:
+        running = self._running
+        device = uncond.device
+        t = torch.tensor([sample.timesteps[sample.position] for sample in running], device=device)
+        t_prev = torch.tensor(
+            [
+                sample.timesteps[sample.position + 1] if sample.position + 1 < len(sample.timesteps) else -1
+                for sample in running
+            ],
+            device=device,
+        )
+        latents, pred_x0 = sampler_step(
+            self.model.model,
+            torch.stack([sample.latent for sample in running]),
+            torch.stack([sample.cond for sample in running]),
+            uncond.expand(len(running), -1, -1),
+            t,
+            t_prev,
+            unconditional_guidance_scale,
+            [sample.sampler for sample in running],
+            [sample.history for sample in running],
+        )
+        for sample, latent, denoised in zip(running, latents, pred_x0):
+            sample.latent = latent
+            sample.position += 1
+            if sample.callback is not None:
+                try:
+                    sample.callback(sample.position, denoised[None])
+                except Exception as e:
+                    sample.future.set_exception(e)
+                    self.cancelled_samples += isinstance(e, SamplingCancelled)
+
+        running = [sample for sample in running if not sample.future.done()]
+        finished = [sample for sample in running if sample.done]
+        self._running = [sample for sample in running if not sample.done]
+        if finished:
+            try:
+                images = self.model.decode_to_tensor(torch.stack([sample.latent for sample in finished]))
+            except Exception as e:
+                # the finished samples already left the running set, fail them here
+                for sample in finished:
+                    sample.future.set_exception(e)
+                raise
+            for sample, image in zip(finished, images):
+                sample.future.set_result(image)
@@ -0,0 +1,51 @@
+import contextlib
+import os
+from typing import ContextManager, Optional
+
+import torch
+
+CPU_PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def cpu_threads() -> int:
+    """Number of CPUs the process may run on, which is lower than ``os.cpu_count()`` in a container."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def cpu_autocast(precision: Optional[str]) -> ContextManager:
+    """Runs the block with bf16 autocast on the CPU when ``precision`` is ``bf16``, as is otherwise."""
+    if precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def optimize_for_cpu(
+    model: torch.nn.Module, precision: str = "bf16", num_threads: Optional[int] = None, channels_last: bool = True
+) -> torch.nn.Module:
+    """Prepares a latent diffusion model for CPU inference, in place.
+
+    The convolution weights of the UNet and the VAE are converted to ``channels_last``, which the oneDNN kernels run
+    faster, and the intra-op thread pool is sized to the CPUs available to the process. With ``int8`` the linear
+    layers of the UNet, the text encoder and the VAE are replaced by dynamically quantized ones, their weights are
+    stored as ``int8`` and the activations quantized on the fly. ``bf16`` keeps the weights in fp32 and relies on the
+    inference running under :func:`cpu_autocast`.
+
+    Args:
+        model: The ldm ``LatentDiffusion`` model.
+        precision: One of ``CPU_PRECISIONS``.
+        num_threads: Number of intra-op threads, all the CPUs available to the process by default.
+        channels_last: Whether to convert the convolution weights to the ``channels_last`` memory format.
+    """
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"Unknown CPU precision {precision}, choose one of {list(CPU_PRECISIONS)}")
+    torch.set_num_threads(num_threads or cpu_threads())
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if precision == "int8":
+        for name in ("model", "cond_stage_model", "first_stage_model"):
+            torch.ao.quantization.quantize_dynamic(
+                getattr(model, name), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+    return model
@@ -1,25 +1,113 @@
+import contextlib
+import threading
+import time
 import typing
-from typing import Any, List
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 from PIL import Image
 from pytorch_lightning import LightningModule
 
+from muse.pipeline.conditioning import ConditioningCache
+from muse.pipeline.cpu import cpu_autocast, optimize_for_cpu
+from muse.pipeline.sampling import sample_ddim
+
 downsampling_factor = 8
 unconditional_guidance_scale = 9.0  # SD2 need higher than SD1 (~7.5)
 
 
-def load_model_from_config(config: Any, ckpt: str, verbose: bool = False) -> torch.nn.Module:
-    from ldm.util import instantiate_from_config
+def to_uint8(images: torch.Tensor) -> np.ndarray:
+    """Converts images of shape ``(B, 3, H, W)`` with values in ``[0, 1]`` into ``uint8`` arrays of shape
+    ``(B, H, W, 3)``."""
+    return (255.0 * images.float().cpu().permute(0, 2, 3, 1).numpy()).astype(np.uint8)
 
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
+
+@contextlib.contextmanager
+def timed(phase: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    """Prints how long the block took and adds it to ``timings[phase]``."""
+    start_time = time.perf_counter()
+    yield
+    secs = time.perf_counter() - start_time
+    print(f"{phase} took {secs:.2f}s")
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + secs
+
+
+_INITIALIZED_LAYERS = (torch.nn.Linear, torch.nn.Conv2d, torch.nn.Embedding, torch.nn.LayerNorm, torch.nn.GroupNorm)
+_skip_weight_init_lock = threading.RLock()
+
+
+def _skipped_in_thread(thread: int, reset_parameters: Callable[[Any], None]) -> Callable[[torch.nn.Module], None]:
+    def maybe_reset_parameters(layer: torch.nn.Module) -> None:
+        if threading.get_ident() != thread:
+            reset_parameters(layer)
+
+    return maybe_reset_parameters
+
+
+@contextlib.contextmanager
+def skip_weight_init() -> Iterator[None]:
+    """Skips the random initialization of the layers the calling thread builds in the block, their weights are loaded
+    right after.
+
+    Layers built by other threads meanwhile are initialized as usual, and concurrent blocks run one at a time.
+    """
+    with _skip_weight_init_lock:
+        reset_parameters = {layer: layer.reset_parameters for layer in _INITIALIZED_LAYERS}
+        for layer, fn in reset_parameters.items():
+            setattr(layer, "reset_parameters", _skipped_in_thread(threading.get_ident(), fn))
+        try:
+            yield
+        finally:
+            for layer, fn in reset_parameters.items():
+                setattr(layer, "reset_parameters", fn)
+
+
+def load_state_dict(ckpt: str, device: Union[str, torch.device] = "cpu") -> Dict[str, torch.Tensor]:
+    """Loads the weights of a checkpoint without reading the whole file into memory.
+
+    ``.safetensors`` files are memory-mapped and their tensors created on ``device`` directly. Pickled checkpoints are
+    memory-mapped on the CPU, except for the legacy non-zip format that has to be read at once.
+    """
+    if str(ckpt).endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(ckpt, device=str(device))
+
+    try:
+        pl_sd = torch.load(ckpt, map_location="cpu", mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):  # torch < 2.1 or legacy checkpoint
+        pl_sd = torch.load(ckpt, map_location="cpu")
     if "global_step" in pl_sd:
         print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    return pl_sd.get("state_dict", pl_sd)
+
+
+def load_model_from_config(
+    config: Any,
+    ckpt: str,
+    verbose: bool = False,
+    device: Union[str, torch.device] = "cpu",
+    timings: Optional[Dict[str, float]] = None,
+) -> torch.nn.Module:
+    """Builds the model of ``config`` with the weights of ``ckpt``.
+
+    The weights are memory-mapped and the model is built without initializing its layers, then the loaded tensors
+    replace its parameters instead of being copied into them. The model never holds a second copy of the weights.
+    """
+    from ldm.util import instantiate_from_config
+
+    print(f"Loading model from {ckpt}")
+    with timed("deserialize", timings):
+        sd = load_state_dict(ckpt, device)
+    with timed("instantiate", timings), skip_weight_init():
+        model = instantiate_from_config(config.model)
+    with timed("load weights", timings):
+        try:
+            m, u = model.load_state_dict(sd, strict=False, assign=True)
+        except TypeError:  # torch < 2.1
+            m, u = model.load_state_dict(sd, strict=False)
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
@@ -31,11 +119,22 @@ def load_model_from_config(config: Any, ckpt: str, verbose: bool = False) -> tor
 
 
 class StableDiffusionModel(LightningModule):
+    """The latent diffusion model of ``config_path`` with the weights of ``weights_path``.
+
+    ``cpu_precision`` enables the CPU inference mode, see :func:`~muse.pipeline.cpu.optimize_for_cpu`: ``fp32``
+    only tunes the threads and memory format, ``bf16`` also runs the model under bf16 autocast and ``int8`` quantizes
+    its linear layers.
+    """
+
     def __init__(
         self,
         device: torch.device,
         config_path: str,
         weights_path: str,
+        conditioning_cache_size: int = 1024,
+        timings: Optional[Dict[str, float]] = None,
+        cpu_precision: Optional[str] = None,
+        num_threads: Optional[int] = None,
     ):
         from ldm.models.diffusion.ddim import DDIMSampler
         from omegaconf import OmegaConf
@@ -44,36 +143,96 @@ class StableDiffusionModel(LightningModule):
 
         config = OmegaConf.load(f"{config_path}")
         config.model.params.cond_stage_config["params"] = {"device": device}
-        self.model = load_model_from_config(config, f"{weights_path}")
+        # the ldm LatentDiffusion model, untyped
+        self.model: Any = load_model_from_config(config, f"{weights_path}", device=device, timings=timings)
+        self.cpu_precision = cpu_precision
+        if cpu_precision is not None:
+            with timed("optimize for cpu", timings):
+                optimize_for_cpu(self.model, cpu_precision, num_threads=num_threads)
         self.sampler = DDIMSampler(self.model)
+        self.conditioning = ConditioningCache(self.model, max_prompts=conditioning_cache_size)
+
+    def autocast(self) -> ContextManager:
+        """The autocast context the model runs in, bf16 in the ``bf16`` CPU mode."""
+        return cpu_autocast(self.cpu_precision)
+
+    @torch.inference_mode()
+    def get_conditioning(self, prompts: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the prompt and the unconditional conditioning of a batch, both served from the conditioning
+        cache."""
+        with self.autocast():
+            return self.conditioning.get(prompts), self.conditioning.unconditional(len(prompts))
+
+    @torch.inference_mode()
+    def decode_to_tensor(self, samples: torch.Tensor) -> torch.Tensor:
+        """Decodes latents with the VAE into images of shape ``(B, 3, H, W)`` with values in ``[0, 1]``, left on the
+        device of the model."""
+        with self.autocast():
+            x_samples = self.model.decode_first_stage(samples)
+        return torch.clamp((x_samples.float() + 1.0) / 2.0, min=0.0, max=1.0)
+
+    @torch.inference_mode()
+    def decode(self, samples: torch.Tensor) -> np.ndarray:
+        """Decodes latents with the VAE into ``uint8`` images of shape ``(B, H, W, 3)``."""
+        return to_uint8(self.decode_to_tensor(samples))
 
     @typing.no_type_check
     @torch.inference_mode()
     def predict_step(
-        self, prompts: List[str], batch_idx: int, height: int, width: int, num_inference_steps: int
+        self,
+        prompts: List[str],
+        batch_idx: int,
+        height: int,
+        width: int,
+        num_inference_steps: Union[int, List[int]],
+        callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+        sampler: str = "ddim",
+        output_type: str = "pil",
     ) -> Any:
+        """Generates an image for each prompt.
+
+        ``num_inference_steps`` is either shared by the batch or given per prompt. With per-prompt step counts the
+        samples are denoised together for as long as they all have steps left, see
+        :func:`~muse.pipeline.sampling.sample_ddim`. ``callback`` is called after every denoising step with the
+        number of steps done and the predicted denoised latents, for example to stream previews. ``sampler`` is one of
+        :data:`~muse.pipeline.sampling.SAMPLERS`, ``DDIMSampler`` only runs the DDIM batches without callback.
+
+        The images are returned as PIL images, or with ``output_type="tensor"`` as the tensor of
+        :meth:`decode_to_tensor`, left on the device of the model.
+        """
         batch_size = len(prompts)
+        if (callback is not None or sampler != "ddim") and not isinstance(num_inference_steps, list):
+            num_inference_steps = [num_inference_steps] * batch_size
 
-        with self.model.ema_scope():
-            uc = self.model.get_learned_conditioning(batch_size * [""])
-            c = self.model.get_learned_conditioning(prompts)
+        with self.model.ema_scope(), self.autocast():
+            c, uc = self.get_conditioning(prompts)
             shape = [4, height // downsampling_factor, width // downsampling_factor]
-            samples_ddim, _ = self.sampler.sample(
-                S=num_inference_steps,
-                conditioning=c,
-                batch_size=batch_size,
-                shape=shape,
-                verbose=False,
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=uc,
-                eta=0.0,
-            )
-
-            x_samples_ddim = self.model.decode_first_stage(samples_ddim)
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-            x_samples_ddim = x_samples_ddim.cpu().permute(0, 2, 3, 1).numpy()
-
-            x_samples_ddim = (255.0 * x_samples_ddim).astype(np.uint8)
+            if isinstance(num_inference_steps, list):
+                samples_ddim = sample_ddim(
+                    self.model,
+                    c,
+                    uc,
+                    num_inference_steps,
+                    tuple(shape),
+                    unconditional_guidance_scale,
+                    callback=callback,
+                    samplers=[sampler] * batch_size,
+                )
+            else:
+                samples_ddim, _ = self.sampler.sample(
+                    S=num_inference_steps,
+                    conditioning=c,
+                    batch_size=batch_size,
+                    shape=shape,
+                    verbose=False,
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    unconditional_conditioning=uc,
+                    eta=0.0,
+                )
+
+            if output_type == "tensor":
+                return self.decode_to_tensor(samples_ddim)
+            x_samples_ddim = self.decode(samples_ddim)
             pil_results = [Image.fromarray(x_sample) for x_sample in x_samples_ddim]
 
         return pil_results
@@ -0,0 +1,19 @@
+import torch
+
+# linear map from the 4 latent channels of the Stable Diffusion 1.x VAE to RGB in [-1, 1]
+LATENT_RGB_FACTORS = (
+    (0.3512, 0.2297, 0.3227),
+    (0.3250, 0.4974, 0.2350),
+    (-0.2829, 0.1762, 0.2721),
+    (-0.2120, -0.2616, -0.7177),
+)
+
+
+def latent_preview(latents: torch.Tensor) -> torch.Tensor:
+    """Approximates the VAE decoding of latents for previews, at a fraction of its cost.
+
+    Returns images of shape ``(B, 3, H / 8, W / 8)`` with values in ``[0, 1]``, at the resolution of the latents.
+    """
+    factors = torch.tensor(LATENT_RGB_FACTORS, device=latents.device, dtype=latents.dtype)
+    rgb = torch.einsum("bchw,cr->brhw", latents, factors)
+    return torch.clamp((rgb + 1.0) / 2.0, min=0.0, max=1.0)
@@ -0,0 +1,173 @@
+import math
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+NUM_TRAIN_TIMESTEPS = 1000
+# DDIM, the second order multistep DPM-Solver++ and Euler ancestral, the last two reach the quality of 50 DDIM steps in
+# about 15 to 20 steps
+SAMPLERS = ("ddim", "dpmpp_2m", "euler_a")
+
+
+class SamplingCancelled(Exception):
+    """Raised by a step callback to stop the sampling loop."""
+
+
+def ddim_timesteps(num_inference_steps: int) -> List[int]:
+    """The uniform DDIM schedule used by ``DDIMSampler``, in sampling order (from noise to image)."""
+    step = NUM_TRAIN_TIMESTEPS // num_inference_steps
+    timesteps = np.asarray(list(range(0, NUM_TRAIN_TIMESTEPS, step))) + 1
+    return timesteps[::-1].tolist()
+
+
+def _sigma(alpha_cumprod: float) -> float:
+    """Noise level of a timestep in the variance exploding parametrization used by the DPM-Solver and Euler
+    samplers."""
+    return math.sqrt((1 - alpha_cumprod) / alpha_cumprod)
+
+
+def _euler_ancestral(x: torch.Tensor, e_t: torch.Tensor, a_t: float, a_prev: float) -> torch.Tensor:
+    sigma, sigma_to = _sigma(a_t), _sigma(a_prev)
+    sigma_up = min(sigma_to, math.sqrt(sigma_to**2 * (sigma**2 - sigma_to**2) / sigma**2))
+    sigma_down = math.sqrt(sigma_to**2 - sigma_up**2)
+    z = x / math.sqrt(a_t) + e_t * (sigma_down - sigma) + torch.randn_like(x) * sigma_up
+    return z * math.sqrt(a_prev)
+
+
+def _dpmpp_2m(
+    x: torch.Tensor, pred_x0: torch.Tensor, a_t: float, a_prev: float, history: Dict[str, Any]
+) -> torch.Tensor:
+    sigma, sigma_to = _sigma(a_t), _sigma(a_prev)
+    lambda_t = -math.log(sigma)
+    if sigma_to == 0:
+        z = pred_x0
+    else:
+        h = -math.log(sigma_to) - lambda_t
+        denoised = pred_x0
+        if "denoised" in history:
+            r = (lambda_t - history["lambda"]) / h
+            denoised = (1 + 1 / (2 * r)) * pred_x0 - (1 / (2 * r)) * history["denoised"]
+        z = (sigma_to / sigma) * x / math.sqrt(a_t) - math.expm1(-h) * denoised
+    history["denoised"], history["lambda"] = pred_x0, lambda_t
+    return z * math.sqrt(a_prev)
+
+
+@torch.no_grad()
+def sampler_step(
+    model: Any,
+    x: torch.Tensor,
+    cond: torch.Tensor,
+    uncond: torch.Tensor,
+    t: torch.Tensor,
+    t_prev: torch.Tensor,
+    guidance_scale: float,
+    samplers: List[str],
+    histories: Optional[List[Dict[str, Any]]] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """One denoising step with classifier-free guidance, every sample with its own timestep and sampler.
+
+    Unlike ``DDIMSampler.p_sample_ddim`` samples at different points of their schedule, following schedules of
+    different lengths or different samplers, share a single UNet call. DDIM is deterministic (``eta=0``), the
+    multistep ``dpmpp_2m`` keeps the denoised latents of the previous step of a sample in its ``histories`` entry.
+
+    Args:
+        model: The latent diffusion model.
+        x: Latents of shape ``(B, 4, H / 8, W / 8)``.
+        cond: Prompt conditioning of shape ``(B, 77, D)``.
+        uncond: Unconditional conditioning of the same shape.
+        t: Current timestep of every sample.
+        t_prev: Next timestep of every sample, ``-1`` for samples at their last step.
+        guidance_scale: Classifier-free guidance scale.
+        samplers: Sampler of every sample, one of ``SAMPLERS``.
+        histories: State of every sample kept between its steps, needed by ``dpmpp_2m``.
+
+    Returns:
+        The latents after the step and the predicted denoised latents.
+    """
+    if histories is None:
+        histories = [{} for _ in samplers]
+    x_in = torch.cat([x, x])
+    t_in = torch.cat([t, t])
+    c_in = torch.cat([uncond, cond])
+    e_t_uncond, e_t = model.apply_model(x_in, t_in, c_in).chunk(2)
+    e_t = e_t_uncond + guidance_scale * (e_t - e_t_uncond)
+
+    alphas_cumprod = model.alphas_cumprod.to(x.dtype)
+    a_t = alphas_cumprod[t].view(-1, 1, 1, 1)
+    # DDIMSampler uses alphas_cumprod[0] as the previous alpha of the last step, the other samplers denoise fully
+    last_alpha = torch.tensor([float(alphas_cumprod[0]) if sampler == "ddim" else 1.0 for sampler in samplers])
+    a_prev = alphas_cumprod[t_prev.clamp(min=0)].view(-1, 1, 1, 1)
+    a_prev = torch.where(t_prev.view(-1, 1, 1, 1) >= 0, a_prev, last_alpha.to(a_prev).view(-1, 1, 1, 1))
+
+    pred_x0 = (x - (1 - a_t).sqrt() * e_t) / a_t.sqrt()
+    x_prev = a_prev.sqrt() * pred_x0 + (1 - a_prev).sqrt() * e_t
+    for i, sampler in enumerate(samplers):
+        if sampler == "euler_a":
+            x_prev[i] = _euler_ancestral(x[i], e_t[i], float(a_t[i]), float(a_prev[i]))
+        elif sampler == "dpmpp_2m":
+            x_prev[i] = _dpmpp_2m(x[i], pred_x0[i], float(a_t[i]), float(a_prev[i]), histories[i])
+    return x_prev, pred_x0
+
+
+def ddim_step(
+    model: Any,
+    x: torch.Tensor,
+    cond: torch.Tensor,
+    uncond: torch.Tensor,
+    t: torch.Tensor,
+    t_prev: torch.Tensor,
+    guidance_scale: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """One deterministic (``eta=0``) DDIM step for the whole batch, see :func:`sampler_step`."""
+    return sampler_step(model, x, cond, uncond, t, t_prev, guidance_scale, ["ddim"] * len(x))
+
+
+@torch.no_grad()
+def sample_ddim(
+    model: Any,
+    cond: torch.Tensor,
+    uncond: torch.Tensor,
+    num_inference_steps: List[int],
+    shape: Tuple[int, int, int],
+    guidance_scale: float,
+    x_T: Optional[torch.Tensor] = None,
+    callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+    samplers: Optional[List[str]] = None,
+) -> torch.Tensor:
+    """Samples a batch in which every sample follows its own schedule, with DDIM unless ``samplers`` gives the
+    sampler of every sample.
+
+    All samples are denoised together while they have steps left, a sample with fewer steps simply leaves the batch
+    once its schedule is done. A batch mixing 25 and 50 step samples runs its first 25 UNet calls over the whole batch
+    and the last 25 over the 50 step samples only.
+
+    ``callback`` is called after every step with the number of steps done and the predicted denoised latents of the
+    batch, it may raise :class:`SamplingCancelled` to stop sampling.
+    """
+    samplers = samplers or ["ddim"] * len(num_inference_steps)
+    histories: List[Dict[str, Any]] = [{} for _ in samplers]
+    schedules = [ddim_timesteps(steps) for steps in num_inference_steps]
+    x = torch.randn((len(schedules), *shape), device=cond.device) if x_T is None else x_T.clone()
+    pred_x0 = torch.zeros_like(x)
+    for position in range(max(len(schedule) for schedule in schedules)):
+        active = [i for i, schedule in enumerate(schedules) if position < len(schedule)]
+        t = torch.tensor([schedules[i][position] for i in active], device=x.device)
+        t_prev = torch.tensor(
+            [schedules[i][position + 1] if position + 1 < len(schedules[i]) else -1 for i in active], device=x.device
+        )
+        index = torch.tensor(active, device=x.device)
+        x[index], pred_x0[index] = sampler_step(
+            model,
+            x[index],
+            cond[index],
+            uncond[index],
+            t,
+            t_prev,
+            guidance_scale,
+            [samplers[i] for i in active],
+            [histories[i] for i in active],
+        )
+        if callback is not None:
+            callback(position + 1, pred_x0)
+    return x
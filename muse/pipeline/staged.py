@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class StageTimings:
+    """Number of items and time spent by a stage."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_secs = 0.0
+        self.last_secs = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, secs: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.total_secs += secs
+            self.last_secs = secs
+
+    def to_dict(self) -> Dict[str, float]:
+        with self._lock:
+            mean_secs = self.total_secs / self.count if self.count else 0.0
+            return {
+                "count": self.count,
+                "total_secs": self.total_secs,
+                "mean_secs": mean_secs,
+                "last_secs": self.last_secs,
+            }
+
+
+class _Job:
+    def __init__(self, item: Any) -> None:
+        self.item = item
+        self.future: Future = Future()
+
+
+class StagedPipeline:
+    """Runs items through a sequence of stages, each stage in its own thread.
+
+    Stages are connected by bounded queues, so while a later stage works on item N an earlier stage already works on
+    item N + 1, for example the GPU denoises the next batch while the CPU encodes the images of the previous one. The
+    output of a stage is the input of the next one, and the output of the last stage is the result of the item.
+
+    Args:
+        stages: ``(name, function)`` pairs in execution order.
+        queue_size: Maximum number of items waiting between two stages.
+    """
+
+    def __init__(self, stages: List[Tuple[str, Callable[[Any], Any]]], queue_size: int = 2) -> None:
+        self.stages = stages
+        self.timings = {name: StageTimings() for name, _ in stages}
+        self._queues: List["queue.Queue[Optional[_Job]]"] = [queue.Queue()]
+        self._queues += [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+        self._threads = [
+            threading.Thread(target=self._run_stage, args=(i,), daemon=True, name=f"stage-{name}")
+            for i, (name, _) in enumerate(stages)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item: Any) -> Future:
+        job = _Job(item)
+        self._queues[0].put(job)
+        return job.future
+
+    def stop(self) -> None:
+        self._queues[0].put(None)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: timings.to_dict() for name, timings in self.timings.items()}
+
+    def _run_stage(self, index: int) -> None:
+        name, fn = self.stages[index]
+        is_last = index == len(self.stages) - 1
+        while True:
+            job = self._queues[index].get()
+            if job is None:
+                if not is_last:
+                    self._queues[index + 1].put(None)
+                return
+            if index == 0 and not job.future.set_running_or_notify_cancel():
+                continue
+
+            start_time = time.perf_counter()
+            try:
+                job.item = fn(job.item)
+            except Exception as e:
+                job.future.set_exception(e)
+                continue
+            finally:
+                self.timings[name].record(time.perf_counter() - start_time)
+
+            if is_last:
+                job.future.set_result(job.item)
+            else:
+                self._queues[index + 1].put(job)
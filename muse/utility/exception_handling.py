@@ -1,12 +1,34 @@
 import asyncio
 import logging
 
+import aiohttp
 import aiohttp.client_exceptions
 from fastapi import HTTPException
 
 from muse.utility.data_io import TimeoutException
 
 
+def is_server_failure(exception: Exception) -> bool:
+    """whether the exception means the model server is unreachable or broken, rather than the request being
+    rejected."""
+    if isinstance(exception, aiohttp.client_exceptions.ClientResponseError):
+        return exception.status >= 500
+    if isinstance(exception, HTTPException):
+        return exception.status_code >= 500
+    return isinstance(exception, (aiohttp.client_exceptions.ClientConnectionError, asyncio.TimeoutError))
+
+
+async def worker_error_detail(response: aiohttp.ClientResponse) -> str:
+    """the ``detail`` of an error response of a model server, its reason phrase when the body has none."""
+    try:
+        body = await response.json(content_type=None)
+    except (ValueError, aiohttp.ClientError):
+        body = None
+    if isinstance(body, dict) and "detail" in body:
+        return body["detail"]
+    return response.reason or "Worker Server error"
+
+
 def raise_granular_exception(exception: Exception):
     """handle the exceptions coming from hitting the model servers."""
     if not isinstance(exception, Exception):
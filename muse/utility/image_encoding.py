@@ -0,0 +1,108 @@
+import base64
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from muse.CONST import IMAGE_FORMATS
+
+
+def encode_image(array: np.ndarray, image_format: str, compress_level: int = 6, webp_quality: int = 80) -> bytes:
+    """Encodes a ``uint8`` image of shape ``(H, W, 3)``.
+
+    ``compress_level`` goes from 0, fastest, to 9, smallest, and only applies to PNG. ``webp_quality`` goes from 0 to
+    100 and only applies to WebP.
+    """
+    buffered = BytesIO()
+    image = Image.fromarray(array)
+    if image_format == "png":
+        image.save(buffered, format="PNG", compress_level=compress_level)
+    else:
+        image.save(buffered, format=image_format.upper(), quality=webp_quality)
+    return buffered.getvalue()
+
+
+def _encode_images(
+    arrays: List[np.ndarray], image_formats: List[str], compress_level: int, webp_quality: int
+) -> List[bytes]:
+    return [encode_image(array, fmt, compress_level, webp_quality) for array, fmt in zip(arrays, image_formats)]
+
+
+def to_data_uri(payload: bytes, image_format: str) -> str:
+    return f"data:image/{image_format};base64,{base64.b64encode(payload).decode('utf-8')}"
+
+
+class ImageEncoder:
+    """Encodes the images of a batch in worker processes, out of the GIL of the model server.
+
+    Images are split in chunks of similar size, one per process, so the arrays are pickled once per chunk instead of
+    once per image. The NSFW placeholder is encoded once for every format when the encoder is created.
+
+    Args:
+        processes: Number of worker processes, ``0`` encodes in the calling thread.
+        compress_level: PNG compression level, from 0, fastest, to 9, smallest.
+        webp_quality: WebP quality, from 0 to 100.
+        placeholder_path: Image returned instead of the images flagged as NSFW.
+    """
+
+    def __init__(
+        self,
+        processes: int = 4,
+        compress_level: int = 6,
+        webp_quality: int = 80,
+        placeholder_path: Optional[str] = "assets/nsfw-warning.png",
+    ) -> None:
+        self.processes = processes
+        self.compress_level = compress_level
+        self.webp_quality = webp_quality
+        self._pool: Optional[ProcessPoolExecutor] = None
+        if processes > 0:
+            # CUDA does not survive a fork, the workers start from a fresh interpreter
+            self._pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        self._placeholders: Dict[str, bytes] = {}
+        if placeholder_path is not None:
+            placeholder = np.asarray(Image.open(placeholder_path).convert("RGB"))
+            self._placeholders = {
+                fmt: encode_image(placeholder, fmt, compress_level, webp_quality) for fmt in IMAGE_FORMATS
+            }
+
+    def encode(
+        self, arrays: List[np.ndarray], image_formats: List[str], nsfw: Optional[List[bool]] = None
+    ) -> List[bytes]:
+        """Encodes every image in its format, the images flagged in ``nsfw`` are replaced by the placeholder."""
+        nsfw = nsfw or [False] * len(arrays)
+        indices = [i for i, flagged in enumerate(nsfw) if not flagged]
+        payloads = {i: self._placeholders[image_formats[i]] for i, flagged in enumerate(nsfw) if flagged}
+
+        if self._pool is None or len(indices) <= 1:
+            encoded = _encode_images(
+                [arrays[i] for i in indices],
+                [image_formats[i] for i in indices],
+                self.compress_level,
+                self.webp_quality,
+            )
+        else:
+            chunks = [indices[k :: self.processes] for k in range(min(self.processes, len(indices)))]
+            futures = [
+                self._pool.submit(
+                    _encode_images,
+                    [arrays[i] for i in chunk],
+                    [image_formats[i] for i in chunk],
+                    self.compress_level,
+                    self.webp_quality,
+                )
+                for chunk in chunks
+            ]
+            indices = [i for chunk in chunks for i in chunk]
+            encoded = [payload for future in futures for payload in future.result()]
+
+        for i, payload in zip(indices, encoded):
+            payloads[i] = payload
+        return [payloads[i] for i in range(len(arrays))]
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
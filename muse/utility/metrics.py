@@ -0,0 +1,11 @@
+from prometheus_client import Counter, Gauge
+
+# exported on the /metrics endpoint of the load balancer next to the starlette_exporter request metrics
+BATCH_RETRIES = Counter("muse_batch_retries_total", "Batches re-sent to another server after a failure", ["quality"])
+BATCH_HEDGES = Counter("muse_batch_hedges_total", "Slow batches also sent to another server", ["quality"])
+COALESCE_LOOKUPS = Counter("muse_coalesce_lookups_total", "Requests checked for an identical request in flight")
+COALESCE_HITS = Counter("muse_coalesce_hits_total", "Requests answered by an identical request in flight")
+RESULT_CACHE_HITS = Counter("muse_result_cache_hits_total", "Requests answered from the result cache", ["tier"])
+RESULT_CACHE_MISSES = Counter("muse_result_cache_misses_total", "Requests not found in the result cache")
+RESULT_CACHE_EVICTIONS = Counter("muse_result_cache_evictions_total", "Results evicted from the result cache", ["tier"])
+RESULT_CACHE_BYTES = Gauge("muse_result_cache_bytes", "Size of the results held by the result cache", ["tier"])
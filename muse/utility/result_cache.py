@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from muse.CONST import IMAGE_SIZE
+from muse.utility.data_io import Data, inference_steps, normalize_prompt
+from muse.utility.metrics import (
+    RESULT_CACHE_BYTES,
+    RESULT_CACHE_EVICTIONS,
+    RESULT_CACHE_HITS,
+    RESULT_CACHE_MISSES,
+)
+
+_RECORD_HEADER = struct.Struct("<II")  # key length, value length
+
+
+def cache_key(data: Data) -> str:
+    """Hash of everything that determines the generated image."""
+    fields = {
+        "prompt": normalize_prompt(data.prompt),
+        "high_quality": data.high_quality,
+        "image_size": IMAGE_SIZE,
+        "image_format": data.image_format,
+    }
+    if data.num_inference_steps is not None or data.sampler != "ddim":
+        # only added when set, so the keys of the requests that use the defaults stay the same
+        fields["num_inference_steps"] = inference_steps(data)
+        fields["sampler"] = data.sampler
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class MemoryLRU:
+    """In-memory LRU bounded by the total size of its values in bytes."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.num_bytes -= len(self._items.pop(key))
+            self._items[key] = value
+            self.num_bytes += len(value)
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.num_bytes -= len(evicted)
+                RESULT_CACHE_EVICTIONS.labels("memory").inc()
+            RESULT_CACHE_BYTES.labels("memory").set(self.num_bytes)
+
+
+class DiskStore:
+    """On-disk store made of append-only segment files, bounded by their total size in bytes.
+
+    Records are appended to the newest segment, a new segment is started once it reaches ``max_bytes / num_segments``
+    and the oldest segment is deleted as a whole when the store grows over ``max_bytes``. The index is rebuilt from the
+    segments on start, so cached results survive restarts of the load balancer.
+    """
+
+    def __init__(self, path: str, max_bytes: int, num_segments: int = 8) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = max(max_bytes // num_segments, 1)
+        self._index: Dict[str, Tuple[int, int, int]] = {}  # {key: (segment id, value offset, value length)}
+        self._segments: List[int] = []
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @property
+    def num_bytes(self) -> int:
+        return sum(os.path.getsize(self._segment_path(segment)) for segment in self._segments)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                return None
+            segment, offset, length = location
+            with open(self._segment_path(segment), "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self.segment_bytes:
+            return
+        encoded_key = key.encode("utf-8")
+        with self._lock:
+            if not self._segments or os.path.getsize(self._segment_path(self._segments[-1])) >= self.segment_bytes:
+                self._segments.append(self._segments[-1] + 1 if self._segments else 0)
+            segment = self._segments[-1]
+            with open(self._segment_path(segment), "ab") as f:
+                offset = f.tell() + _RECORD_HEADER.size + len(encoded_key)
+                f.write(_RECORD_HEADER.pack(len(encoded_key), len(value)) + encoded_key + value)
+            self._index[key] = (segment, offset, len(value))
+            self._evict()
+            RESULT_CACHE_BYTES.labels("disk").set(self.num_bytes)
+
+    def _evict(self) -> None:
+        while len(self._segments) > 1 and self.num_bytes > self.max_bytes:
+            segment = self._segments.pop(0)
+            os.remove(self._segment_path(segment))
+            evicted = [key for key, location in self._index.items() if location[0] == segment]
+            for key in evicted:
+                del self._index[key]
+            RESULT_CACHE_EVICTIONS.labels("disk").inc(len(evicted))
+
+    def _load(self) -> None:
+        segments = sorted(int(name.split(".")[0]) for name in os.listdir(self.path) if name.endswith(".seg"))
+        for segment in segments:
+            with open(self._segment_path(segment), "rb+") as f:
+                data = f.read()
+                position = 0
+                while position + _RECORD_HEADER.size <= len(data):
+                    key_length, value_length = _RECORD_HEADER.unpack_from(data, position)
+                    end = position + _RECORD_HEADER.size + key_length + value_length
+                    if end > len(data):
+                        break
+                    key = data[position + _RECORD_HEADER.size : position + _RECORD_HEADER.size + key_length]
+                    self._index[key.decode("utf-8")] = (segment, end - value_length, value_length)
+                    position = end
+                # drop a record left incomplete by an interrupted write
+                f.truncate(position)
+            self._segments.append(segment)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"{segment:08d}.seg")
+
+
+class ResultCache:
+    """Two-tier cache of generated results, a byte-bounded memory LRU in front of an optional on-disk store.
+
+    Args:
+        memory_bytes: Size of the memory tier in bytes.
+        disk_path: Directory of the disk tier, the disk tier is disabled when it is not set.
+        disk_bytes: Size of the disk tier in bytes.
+    """
+
+    def __init__(self, memory_bytes: int, disk_path: Optional[str] = None, disk_bytes: int = 0) -> None:
+        self.memory = MemoryLRU(memory_bytes)
+        self.disk = DiskStore(disk_path, disk_bytes) if disk_path and disk_bytes else None
+
+    def get(self, key: str) -> Optional[dict]:
+        value = self.memory.get(key)
+        if value is not None:
+            RESULT_CACHE_HITS.labels("memory").inc()
+            return json.loads(value)
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                RESULT_CACHE_HITS.labels("disk").inc()
+                self.memory.put(key, value)
+                return json.loads(value)
+        RESULT_CACHE_MISSES.inc()
+        return None
+
+    def put(self, key: str, result: dict) -> None:
+        value = json.dumps(result).encode("utf-8")
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
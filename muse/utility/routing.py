@@ -0,0 +1,288 @@
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Type, Union
+
+QUALITIES = ("high", "low")
+DEFAULT_LATENCY = {"high": 10.0, "low": 5.0}  # seconds, used until a batch of that quality has been observed
+
+
+class ServerStats:
+    """Tracks the batches in flight on a model server and an EWMA of its batch latency for each quality."""
+
+    def __init__(self, alpha: float) -> None:
+        self.alpha = alpha
+        self.in_flight = {quality: 0 for quality in QUALITIES}
+        self.latency: Dict[str, float] = {}  # {quality: EWMA of the batch latency in seconds}
+
+    @property
+    def total_in_flight(self) -> int:
+        return sum(self.in_flight.values())
+
+    def observe(self, quality: str, latency: float) -> None:
+        if quality in self.latency:
+            self.latency[quality] = self.alpha * latency + (1 - self.alpha) * self.latency[quality]
+        else:
+            self.latency[quality] = latency
+
+
+class NoServerAvailable(Exception):
+    """Raised by :meth:`Router.acquire` when every server is excluded, ejected or still warming up."""
+
+
+def fleet_latency(stats: Dict[str, ServerStats], servers: List[str], quality: str) -> float:
+    """Average batch latency of the servers that processed a batch of this quality."""
+    observed = [stats[server].latency[quality] for server in servers if quality in stats[server].latency]
+    if not observed:
+        return DEFAULT_LATENCY[quality]
+    return sum(observed) / len(observed)
+
+
+class CircuitBreaker:
+    """Ejects a server after repeated failures and re-admits it through a half-open trial.
+
+    ``closed``: the server receives batches. After ``failure_threshold`` consecutive failures the breaker opens.
+    ``open``: the server is ejected for ``ejection_secs``, doubled after every failed trial up to ``max_ejection_secs``.
+    ``half_open``: a single trial batch is let through, its success closes the breaker and its failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        ejection_secs: float = 10.0,
+        max_ejection_secs: float = 120.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.base_ejection_secs = ejection_secs
+        self.max_ejection_secs = max_ejection_secs
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.ejection_secs = ejection_secs
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    @property
+    def available(self) -> bool:
+        if self.state == self.OPEN and self.clock() - self.opened_at >= self.ejection_secs:
+            self.state = self.HALF_OPEN
+            self.trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            return not self.trial_in_flight
+        return self.state == self.CLOSED
+
+    def on_dispatch(self) -> None:
+        if self.state == self.HALF_OPEN:
+            self.trial_in_flight = True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self.ejection_secs = self.base_ejection_secs
+        self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.ejection_secs = min(self.ejection_secs * 2, self.max_ejection_secs)
+            self._open()
+        elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def record_probe(self, healthy: bool) -> None:
+        """Applies the result of an active health check.
+
+        A successful probe shortens the ejection of an open server, it still has to pass a half-open trial batch.
+        """
+        if not healthy:
+            self.record_failure()
+        elif self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+            self.trial_in_flight = False
+        elif self.state == self.CLOSED:
+            self.failures = 0
+
+    def _open(self) -> None:
+        self.state = self.OPEN
+        self.opened_at = self.clock()
+        self.trial_in_flight = False
+
+
+class RoutingPolicy:
+    """Decides which server the next batch is sent to."""
+
+    def select(self, servers: List[str], stats: Dict[str, ServerStats], quality: str) -> str:
+        raise NotImplementedError
+
+
+class RoundRobinPolicy(RoutingPolicy):
+    def __init__(self) -> None:
+        self._index = 0
+
+    def select(self, servers: List[str], stats: Dict[str, ServerStats], quality: str) -> str:
+        server = servers[self._index % len(servers)]
+        self._index += 1
+        return server
+
+
+class LeastOutstandingPolicy(RoutingPolicy):
+    """Picks the server with the fewest batches in flight, ties are broken in round-robin order."""
+
+    def __init__(self) -> None:
+        self._index = 0
+
+    def select(self, servers: List[str], stats: Dict[str, ServerStats], quality: str) -> str:
+        offset = self._index % len(servers)
+        self._index += 1
+        rotated = servers[offset:] + servers[:offset]
+        return min(rotated, key=lambda server: stats[server].total_in_flight)
+
+
+class ExpectedCompletionPolicy(LeastOutstandingPolicy):
+    """Picks the server expected to finish the batch first.
+
+    A model server processes its batches one after the other, so the batch completes after the server's queued work
+    plus the batch itself, each estimated with the server's EWMA latency for that quality. Servers without a latency
+    observation yet use the fleet average.
+    """
+
+    def select(self, servers: List[str], stats: Dict[str, ServerStats], quality: str) -> str:
+        offset = self._index % len(servers)
+        self._index += 1
+        rotated = servers[offset:] + servers[:offset]
+        latency_estimates = {q: fleet_latency(stats, servers, q) for q in QUALITIES}
+
+        def expected_completion(server: str) -> float:
+            server_stats = stats[server]
+            latency = {q: server_stats.latency.get(q, latency_estimates[q]) for q in QUALITIES}
+            queued = sum(server_stats.in_flight[q] * latency[q] for q in QUALITIES)
+            return queued + latency[quality]
+
+        return min(rotated, key=expected_completion)
+
+
+ROUTING_POLICIES: Dict[str, Type[RoutingPolicy]] = {
+    "round_robin": RoundRobinPolicy,
+    "least_outstanding": LeastOutstandingPolicy,
+    "expected_completion": ExpectedCompletionPolicy,
+}
+
+
+class Router:
+    """Keeps per-server statistics and circuit breakers, and delegates the choice between the servers that are ready
+    and not ejected to a :class:`RoutingPolicy`.
+
+    Args:
+        policy: Name of a policy in ``ROUTING_POLICIES`` or a ``RoutingPolicy`` instance.
+        alpha: Smoothing factor of the latency EWMA, higher values favour recent batches.
+        failure_threshold: Consecutive failures after which a server is ejected.
+        ejection_secs: Initial number of seconds an ejected server waits before its half-open trial.
+        clock: Time source of the circuit breakers.
+    """
+
+    def __init__(
+        self,
+        policy: Union[str, RoutingPolicy] = "expected_completion",
+        alpha: float = 0.3,
+        failure_threshold: int = 3,
+        ejection_secs: float = 10.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if isinstance(policy, str):
+            if policy not in ROUTING_POLICIES:
+                raise ValueError(f"Unknown routing policy {policy}, choose one of {list(ROUTING_POLICIES)}")
+            policy = ROUTING_POLICIES[policy]()
+        self.policy = policy
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.ejection_secs = ejection_secs
+        self.clock = clock
+        self.servers: List[str] = []
+        self.stats: Dict[str, ServerStats] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.ready: Dict[str, bool] = {}
+
+    def update_servers(self, servers: List[str], ready: bool = True) -> None:
+        """Sets the servers to route to, the new ones start as ``ready`` and the others keep their state."""
+        self.servers = list(servers)
+        self.ready = {server: self.ready.get(server, ready) for server in self.servers}
+        self.stats = {server: self.stats.get(server) or ServerStats(self.alpha) for server in self.servers}
+        self.breakers = {server: self.breakers.get(server) or self._new_breaker() for server in self.servers}
+
+    def _new_breaker(self) -> CircuitBreaker:
+        return CircuitBreaker(self.failure_threshold, self.ejection_secs, clock=self.clock)
+
+    def available_servers(self, exclude: Iterable[str] = ()) -> List[str]:
+        exclude = set(exclude)
+        return [
+            server
+            for server in self.servers
+            if server not in exclude and self.ready[server] and self.breakers[server].available
+        ]
+
+    @property
+    def ejected_servers(self) -> List[str]:
+        return [server for server in self.servers if self.breakers[server].state != CircuitBreaker.CLOSED]
+
+    @property
+    def warming_servers(self) -> List[str]:
+        return [server for server in self.servers if not self.ready[server]]
+
+    def acquire(self, quality: str, exclude: Iterable[str] = ()) -> str:
+        """Selects a server for a batch and counts the batch as in flight on it."""
+        servers = self.available_servers(exclude)
+        if not servers:
+            raise NoServerAvailable("None of the workers are healthy!")
+        server = self.policy.select(servers, self.stats, quality)
+        self.stats[server].in_flight[quality] += 1
+        self.breakers[server].on_dispatch()
+        return server
+
+    def release(self, server: str, quality: str, latency: Optional[float] = None, failed: bool = False) -> None:
+        """Marks a batch as finished.
+
+        ``latency`` is given for batches that completed successfully, ``failed`` for batches that failed because of the
+        server. Other outcomes, for example a rejected request, leave the circuit breaker untouched.
+        """
+        if server not in self.stats:  # the server was removed while the batch was in flight
+            return
+        stats = self.stats[server]
+        stats.in_flight[quality] = max(stats.in_flight[quality] - 1, 0)
+        if latency is not None:
+            stats.observe(quality, latency)
+            self.breakers[server].record_success()
+        elif failed:
+            self.breakers[server].record_failure()
+        else:
+            self.breakers[server].trial_in_flight = False
+
+    def fleet_latency(self, quality: str) -> float:
+        return fleet_latency(self.stats, self.available_servers(), quality)
+
+    def estimate_wait(self, quality: str, queued_batches: Dict[str, int]) -> float:
+        """Estimates the seconds until a new request of this quality is answered.
+
+        The work in flight on the available servers and the batches still queued in the load balancer are spread over
+        the available servers, followed by the request's own batch. Returns ``inf`` when no server is available.
+        """
+        servers = self.available_servers()
+        if not servers:
+            return float("inf")
+        latency = {q: fleet_latency(self.stats, servers, q) for q in QUALITIES}
+        work = sum(
+            self.stats[server].in_flight[q] * self.stats[server].latency.get(q, latency[q])
+            for server in servers
+            for q in QUALITIES
+        )
+        work += sum(queued_batches.get(q, 0) * latency[q] for q in QUALITIES)
+        return work / len(servers) + latency[quality]
+
+    def record_probe(self, server: str, healthy: bool, ready: Optional[bool] = None) -> None:
+        """Applies the result of a health check, ``ready`` tells whether a healthy server is done warming up."""
+        if server in self.breakers:
+            self.breakers[server].record_probe(healthy)
+            if ready is not None:
+                self.ready[server] = ready
@@ -0,0 +1,300 @@
+import contextlib
+import hashlib
+import http.client
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows, downloads of the same file by several workers are not serialized
+    fcntl = None  # type: ignore[assignment]
+
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+CHUNK_BYTES = 1 << 20
+
+T = TypeVar("T")
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def is_archive(url: str) -> bool:
+    return url.endswith(ARCHIVE_SUFFIXES)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _extract(fileobj: Union[BinaryIO, "_TeeReader"], target_folder: Path) -> None:
+    """Extracts a tar archive read sequentially from ``fileobj``."""
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        if hasattr(tarfile, "data_filter"):
+            archive.extractall(target_folder, filter="data")
+        else:
+            archive.extractall(target_folder)
+
+
+class _TeeReader(io.RawIOBase):
+    """Reads the bytes already downloaded to ``part`` then the rest from ``response``, appending them to ``part``.
+
+    Every byte read goes through ``digest``, so the checksum of a resumed download covers the whole file.
+    """
+
+    def __init__(self, part: Path, offset: int, response: BinaryIO, digest: "hashlib._Hash") -> None:
+        super().__init__()
+        self._existing = open(part, "rb") if offset else None
+        self._remaining_existing = offset
+        self._response = response
+        self._part = open(part, "r+b" if offset else "wb")
+        self._part.seek(offset)
+        self._digest = digest
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        size = CHUNK_BYTES if size is None or size < 0 else size
+        if self._existing is not None and self._remaining_existing:
+            data = self._existing.read(min(size, self._remaining_existing))
+            self._remaining_existing -= len(data)
+        else:
+            data = self._response.read(size)
+            self._part.write(data)
+        self._digest.update(data)
+        return data
+
+    def drain(self) -> None:
+        while self.read(CHUNK_BYTES):
+            pass
+
+    def close(self) -> None:
+        if self._existing is not None:
+            self._existing.close()
+        self._part.close()
+        super().close()
+
+
+class WeightCache:
+    """Downloads weights into a content-addressed cache shared by the workers of a node.
+
+    Files are stored under ``blobs/<sha256>`` and ``urls/`` maps every downloaded URL to its blob, so a file is fetched
+    once per node whatever the number of workers, and files with the same content are stored once. A lock per URL makes
+    the workers that start together wait for the first download instead of repeating it.
+
+    Large files are fetched with ``num_connections`` parallel HTTP range requests. The progress of every range is
+    saved next to the partial file every ``progress_interval`` seconds and when a request ends, an interrupted download
+    resumes where it stopped, in the same process after a failed request and in the next one after a crash. Archives
+    are fetched over a single connection and extracted while they arrive. A download whose checksum does not match
+    ``sha256`` is discarded.
+
+    Args:
+        root: Directory of the cache.
+        num_connections: Maximum number of parallel range requests of a download.
+        min_part_bytes: Minimum size of the part fetched by each range request.
+        max_attempts: Number of attempts of a request before the download fails.
+        timeout: Timeout of the requests in seconds.
+        progress_interval: Minimum number of seconds between two saves of the progress of a download.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        num_connections: int = 8,
+        min_part_bytes: int = 32 << 20,
+        max_attempts: int = 5,
+        timeout: float = 60,
+        progress_interval: float = 1.0,
+    ) -> None:
+        self.root = Path(root)
+        self.num_connections = num_connections
+        self.min_part_bytes = min_part_bytes
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+        for folder in ("blobs", "urls", "partial", "locks"):
+            (self.root / folder).mkdir(parents=True, exist_ok=True)
+
+    def fetch(self, url: str, sha256: Optional[str] = None, extract_to: Optional[Path] = None) -> Path:
+        """Returns the path of the cached content of ``url``, downloading it when needed.
+
+        Archives are extracted to ``extract_to`` when it is given.
+        """
+        with self._lock(url):
+            blob = self._lookup(url, sha256)
+            if blob is None:
+                blob = self._download(url, sha256, extract_to)
+            elif extract_to is not None and tarfile.is_tarfile(blob):
+                with open(blob, "rb") as f:
+                    _extract(f, extract_to)
+        return blob
+
+    def _lookup(self, url: str, sha256: Optional[str]) -> Optional[Path]:
+        if sha256 is None:
+            index = self._url_path(url)
+            if not index.exists():
+                return None
+            sha256 = index.read_text().strip()
+        blob = self.root / "blobs" / sha256
+        return blob if blob.exists() else None
+
+    def _download(self, url: str, sha256: Optional[str], extract_to: Optional[Path]) -> Path:
+        part = self.root / "partial" / self._url_key(url)
+        size, accepts_ranges = self._probe(url)
+        extracted = extract_to is not None and is_archive(url)
+        if extracted or not accepts_ranges or size is None or size < 2 * self.min_part_bytes:
+            digest = self._retry(
+                lambda: self._download_stream(url, part, accepts_ranges, extract_to if extracted else None)
+            )
+        else:
+            self._download_ranges(url, part, size)
+            digest = file_sha256(part)
+
+        if sha256 is not None and digest != sha256:
+            part.unlink()
+            self._progress_path(part).unlink(missing_ok=True)
+            raise ChecksumError(f"{url} has the checksum {digest} instead of {sha256}")
+        blob = self.root / "blobs" / digest
+        os.replace(part, blob)
+        self._progress_path(part).unlink(missing_ok=True)
+        self._url_path(url).write_text(digest)
+        if extract_to is not None and not extracted and tarfile.is_tarfile(blob):
+            with open(blob, "rb") as f:
+                _extract(f, extract_to)
+        return blob
+
+    def _probe(self, url: str) -> Tuple[Optional[int], bool]:
+        """Returns the size of the file and whether the server accepts range requests."""
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=self.timeout) as response:
+                size = response.headers.get("Content-Length")
+                return (int(size) if size else None), response.headers.get("Accept-Ranges") == "bytes"
+        except urllib.error.URLError:
+            return None, False
+
+    def _download_stream(self, url: str, part: Path, resume: bool, extract_to: Optional[Path]) -> str:
+        """Downloads over a single connection, from the end of the partial file when the server accepts ranges."""
+        if self._progress_path(part).exists():
+            # the partial file of a range download is allocated at its full size
+            part.unlink(missing_ok=True)
+            self._progress_path(part).unlink()
+        offset = part.stat().st_size if resume and part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout) as response:
+            if offset and response.status != 206:
+                offset = 0
+            length = response.headers.get("Content-Length")
+            digest = hashlib.sha256()
+            reader = _TeeReader(part, offset, response, digest)
+            try:
+                if extract_to is not None:
+                    _extract(reader, extract_to)
+                reader.drain()
+            finally:
+                reader.close()
+        if length is not None and part.stat().st_size != offset + int(length):
+            raise http.client.IncompleteRead(b"", offset + int(length) - part.stat().st_size)
+        return digest.hexdigest()
+
+    def _download_ranges(self, url: str, part: Path, size: int) -> None:
+        num_parts = max(min(self.num_connections, size // self.min_part_bytes), 1)
+        bounds = [(i * size // num_parts, (i + 1) * size // num_parts - 1) for i in range(num_parts)]
+        done = self._load_progress(part, size, bounds)
+        if done is None:
+            with open(part, "wb") as f:
+                f.truncate(size)
+            done = [0] * num_parts
+        progress_lock = threading.Lock()
+        last_save = [time.monotonic()]
+
+        def save_progress() -> None:
+            self._save_progress(part, size, bounds, done)
+            last_save[0] = time.monotonic()
+
+        def fetch_range(i: int) -> None:
+            start, end = bounds[i]
+            headers = {"Range": f"bytes={start + done[i]}-{end}"}
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout) as response:
+                if response.status != 206:
+                    raise urllib.error.URLError(f"{url} does not support range requests")
+                with open(part, "r+b") as f:
+                    f.seek(start + done[i])
+                    try:
+                        while start + done[i] <= end:
+                            chunk = response.read(min(CHUNK_BYTES, end + 1 - start - done[i]))
+                            if not chunk:
+                                raise urllib.error.URLError(f"{url} closed the connection")
+                            f.write(chunk)
+                            f.flush()
+                            with progress_lock:
+                                done[i] += len(chunk)
+                                if time.monotonic() - last_save[0] >= self.progress_interval:
+                                    save_progress()
+                    finally:
+                        with progress_lock:
+                            save_progress()
+
+        with ThreadPoolExecutor(max_workers=num_parts) as pool:
+            for future in [pool.submit(self._retry, lambda i=i: fetch_range(i)) for i in range(num_parts)]:
+                future.result()
+
+    def _retry(self, fn: Callable[[], T]) -> T:
+        """Calls ``fn`` until it succeeds, with an exponential backoff, every call resumes from the saved progress."""
+        for attempt in range(self.max_attempts - 1):
+            try:
+                return fn()
+            except (urllib.error.URLError, http.client.HTTPException, OSError):
+                time.sleep(min(0.1 * 2**attempt, 5))
+        return fn()
+
+    def _load_progress(self, part: Path, size: int, bounds: List[Tuple[int, int]]) -> Optional[List[int]]:
+        """Returns the bytes downloaded in each range by a previous attempt, ``None`` to start over."""
+        path = self._progress_path(part)
+        if not part.exists() or not path.exists():
+            return None
+        progress = json.loads(path.read_text())
+        if progress["size"] != size or [tuple(b) for b in progress["bounds"]] != bounds:
+            return None
+        return progress["done"]
+
+    def _save_progress(self, part: Path, size: int, bounds: List[Tuple[int, int]], done: List[int]) -> None:
+        path = self._progress_path(part)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"size": size, "bounds": bounds, "done": done}))
+        os.replace(tmp_path, path)
+
+    @contextlib.contextmanager
+    def _lock(self, url: str) -> Iterator[None]:
+        with open(self.root / "locks" / self._url_key(url), "w") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _url_path(self, url: str) -> Path:
+        return self.root / "urls" / self._url_key(url)
+
+    @staticmethod
+    def _url_key(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _progress_path(part: Path) -> Path:
+        return part.with_suffix(".progress")
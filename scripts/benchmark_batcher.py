@@ -0,0 +1,129 @@
+"""Compares the queueing delay of the LoadBalancer batcher against the previous fixed-interval polling loop.
+
+Requests are enqueued at a steady rate with a configurable share of high quality requests. No model server is
+involved, the time between a request being enqueued and its batch being dispatched is measured.
+
+    python scripts/benchmark_batcher.py --num-requests 1000 --rate 200
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from muse.components.load_balancer import LoadBalancer
+from muse.utility.data_io import Data, batch_key
+
+
+class PollingBatcher:
+    """The previous consumer: wakes every 100 ms and uses one timestamp shared by every quality queue."""
+
+    def __init__(self, max_batch_size: int, batch_timeout_secs: float, send_batch):
+        self.max_batch_size = max_batch_size
+        self.batch_timeout_secs = batch_timeout_secs
+        self.send_batch = send_batch
+        self._batch = {"high": [], "low": []}
+        self._last_batch_sent = time.monotonic()
+
+    def put(self, request, high_quality: bool):
+        self._batch["high" if high_quality else "low"].append(request)
+
+    async def consumer(self):
+        while True:
+            await asyncio.sleep(0.1)
+            has_sent = False
+            for quality in self._batch.keys():
+                batch = self._batch[quality][: self.max_batch_size]
+                while batch and (
+                    (len(batch) >= self.max_batch_size)
+                    or ((time.monotonic() - self._last_batch_sent) > self.batch_timeout_secs)  # noqa: W503
+                ):
+                    has_sent = True
+                    self.send_batch(batch)
+                    self._batch[quality] = self._batch[quality][self.max_batch_size :]
+                    batch = self._batch[quality][: self.max_batch_size]
+            if has_sent:
+                self._last_batch_sent = time.monotonic()
+
+
+class RecordingLoadBalancer(LoadBalancer):
+    def __init__(self, on_batch, **kwargs):
+        super().__init__(**kwargs)
+        self._on_batch = on_batch
+
+    async def send_batch(self, batch):
+        self._on_batch(batch)
+
+
+class DeadlineBatcher:
+    """Drives ``LoadBalancer.consumer`` with a recording ``send_batch``."""
+
+    def __init__(self, max_batch_size: int, batch_timeout_secs: float, send_batch):
+        self.load_balancer = RecordingLoadBalancer(
+            send_batch, max_batch_size=max_batch_size, batch_timeout_secs=batch_timeout_secs
+        )
+
+    def put(self, request, high_quality: bool):
+        self.load_balancer._batch[batch_key(Data(**request[1]))].append(request)
+        if self.load_balancer._batch_event is not None:
+            self.load_balancer._batch_event.set()
+
+    async def consumer(self):
+        await self.load_balancer.consumer()
+
+
+async def measure(batcher_cls, args) -> dict:
+    delays, batch_sizes = [], []
+
+    def send_batch(batch):
+        now = time.monotonic()
+        batch_sizes.append(len(batch))
+        delays.extend(now - request[2] for request in batch)
+
+    batcher = batcher_cls(args.max_batch_size, args.batch_timeout_secs, send_batch)
+    task = asyncio.create_task(batcher.consumer())
+    await asyncio.sleep(0)
+
+    rng = random.Random(args.seed)
+    for i in range(args.num_requests):
+        high_quality = rng.random() < args.high_quality_ratio
+        data = Data(prompt=f"prompt {i}", high_quality=high_quality).dict()
+        batcher.put((str(i), data, time.monotonic()), high_quality)
+        await asyncio.sleep(rng.expovariate(args.rate))
+
+    while len(delays) < args.num_requests:
+        await asyncio.sleep(0.01)
+    task.cancel()
+
+    delays.sort()
+    return {
+        "mean": statistics.mean(delays),
+        "p50": delays[len(delays) // 2],
+        "p95": delays[int(len(delays) * 0.95)],
+        "max": delays[-1],
+        "batches": len(batch_sizes),
+        "mean_batch_size": statistics.mean(batch_sizes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-requests", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=200.0, help="requests per second")
+    parser.add_argument("--high-quality-ratio", type=float, default=0.1)
+    parser.add_argument("--max-batch-size", type=int, default=12)
+    parser.add_argument("--batch-timeout-secs", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    for name, batcher_cls in (("polling", PollingBatcher), ("deadline", DeadlineBatcher)):
+        stats = asyncio.run(measure(batcher_cls, args))
+        print(
+            f"{name:>9}: mean={stats['mean'] * 1000:8.1f}ms p50={stats['p50'] * 1000:8.1f}ms "
+            f"p95={stats['p95'] * 1000:8.1f}ms max={stats['max'] * 1000:8.1f}ms "
+            f"batches={stats['batches']} mean_batch_size={stats['mean_batch_size']:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compares the CPU serving precisions of StableDiffusionModel against the fp32 baseline.
+
+Every precision generates the same images, same prompts and same seeds, and reports its seconds per image and the
+CLIP score of its images. The CLIP score is the cosine similarity between the CLIP embeddings of an image and of its
+prompt, times 100; the drift is the mean absolute difference with the score of the fp32 image of the same prompt and
+seed, which tells how much a precision changes the images.
+
+    python scripts/benchmark_cpu.py --config v1-inference.yaml --weights v1-5-pruned-emaonly.ckpt --precisions fp32 bf16
+"""
+import argparse
+import statistics
+import time
+from typing import Dict, List
+
+import torch
+
+from muse.components.stable_diffusion_serve import clip_preprocess
+from muse.pipeline import StableDiffusionModel
+from muse.pipeline.cpu import CPU_PRECISIONS
+
+PROMPTS = [
+    "a lighthouse on a cliff at sunset",
+    "a bowl of ramen, studio photography",
+    "an astronaut riding a horse, oil painting",
+    "a cozy reading nook with a cat, watercolor",
+    "a futuristic city at night with neon lights",
+    "a portrait of an old fisherman, charcoal drawing",
+    "a red sports car in the rain",
+    "a field of sunflowers under a stormy sky",
+]
+
+
+class CLIPScorer:
+    """Scores the agreement of images with their prompts with the CLIP model of the safety checker."""
+
+    def __init__(self):
+        import clip as openai_clip
+
+        self.device = torch.device("cpu")
+        self.model, _ = openai_clip.load("ViT-B/32", device=self.device)
+        self.resolution = self.model.visual.input_resolution
+
+    @torch.inference_mode()
+    def __call__(self, images: torch.Tensor, prompts: List[str]) -> List[float]:
+        import clip as openai_clip
+
+        images = clip_preprocess(images, self.resolution, self.device, self.model.dtype)
+        encoded_images = torch.nn.functional.normalize(self.model.encode_image(images), dim=1)
+        encoded_text = self.model.encode_text(openai_clip.tokenize(prompts, truncate=True))
+        encoded_text = torch.nn.functional.normalize(encoded_text, dim=1)
+        return (100 * (encoded_images * encoded_text).sum(dim=1)).tolist()
+
+
+def measure(precision: str, args, scorer: CLIPScorer) -> Dict[str, object]:
+    model = StableDiffusionModel(
+        "cpu", args.config, args.weights, cpu_precision=precision, num_threads=args.num_threads
+    ).eval()
+    prompts = PROMPTS[: args.num_prompts]
+
+    # the first batch pays for the oneDNN kernel selection, it is not timed
+    model.predict_step(prompts[:1], 0, args.image_size, args.image_size, 2)
+
+    images, secs = [], []
+    for seed, prompt in enumerate(prompts):
+        torch.manual_seed(args.seed + seed)
+        start_time = time.perf_counter()
+        images.append(
+            model.predict_step([prompt], 0, args.image_size, args.image_size, args.steps, output_type="tensor")
+        )
+        secs.append(time.perf_counter() - start_time)
+
+    return {"secs_per_image": statistics.mean(secs), "clip_scores": scorer(torch.cat(images), prompts)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", required=True, help="model config, like SD_CONFIG_URL")
+    parser.add_argument("--weights", required=True, help="checkpoint, like SD_CHECKPOINT_URL")
+    parser.add_argument("--precisions", nargs="+", default=["bf16", "int8"], choices=CPU_PRECISIONS)
+    parser.add_argument("--num-prompts", type=int, default=len(PROMPTS))
+    parser.add_argument("--steps", type=int, default=25)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    scorer = CLIPScorer()
+    baseline = measure("fp32", args, scorer)
+    results = {"fp32": baseline}
+    for precision in args.precisions:
+        if precision != "fp32":
+            results[precision] = measure(precision, args, scorer)
+
+    for precision, stats in results.items():
+        scores, baseline_scores = stats["clip_scores"], baseline["clip_scores"]
+        drift = statistics.mean(abs(score - base) for score, base in zip(scores, baseline_scores))
+        print(
+            f"{precision:>5}: {stats['secs_per_image']:7.2f}s/image "
+            f"speedup={baseline['secs_per_image'] / stats['secs_per_image']:5.2f}x "
+            f"clip_score={statistics.mean(scores):6.2f} drift={drift:5.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Benchmarks the LoadBalancer in front of a simulated fleet of model servers, locally and without GPUs.
+
+For every combination of ``--batch-sizes`` and ``--batch-timeouts`` a LoadBalancer is started with
+``start_fastapi_app`` in its own process, in front of ``--num-servers`` fake model servers, and ``--num-requests``
+requests with distinct prompts arrive at ``--rate`` requests per second. A fake server processes
+``--server-concurrency`` batches at a time. Each batch takes ``latency_base + latency_per_image * batch size``
+seconds, twice as long at high quality and ``--slow-factor`` times as long on the ``--slow-servers``. That time is
+multiplied by a random factor of mean 1 drawn from ``--latency-distribution``, and the batch fails with a 500 with
+probability ``--failure-rate``.
+
+Every setting reports the throughput, the p50/p95/p99 end-to-end latency, the queueing delay in the load balancer
+(from a request being sent to its batch reaching a server), and the batch fill ratio (mean batch size over
+``max_batch_size``). Results are written as JSON with ``--output``, and ``--compare`` prints the change against a
+previous results file.
+
+    python scripts/benchmark_load_balancer.py --num-servers 4 --rate 8 --num-requests 400 \\
+        --batch-sizes 4 8 12 --batch-timeouts 0.5 2 --output results.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from muse.components.load_balancer import LoadBalancer
+from muse.utility.data_io import Data
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"mean": None, "p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+    return {
+        "mean": statistics.mean(values),
+        **{f"p{q}": values[min(int(len(values) * q / 100), len(values) - 1)] for q in (50, 95, 99)},
+    }
+
+
+def run_load_balancer(port: int, servers: List[str], max_batch_size: int, batch_timeout_secs: float):
+    load_balancer = LoadBalancer(max_batch_size=max_batch_size, batch_timeout_secs=batch_timeout_secs, port=port)
+    load_balancer.servers = servers
+    load_balancer.start_fastapi_app()
+
+
+class FakeFleet:
+    """Model servers answering ``/api/predict`` after a simulated batch latency, and the readiness probes."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.urls: List[str] = []
+        self._runners: List[web.AppRunner] = []
+        self.reset()
+
+    def reset(self):
+        self.batch_sizes: List[int] = []
+        self.received: Dict[str, float] = {}  # {prompt: monotonic time its first batch reached a server}
+        self.probed = set()
+
+    def batch_latency(self, batch_size: int, high_quality: bool, slow: bool) -> float:
+        latency = self.args.latency_base + self.args.latency_per_image * batch_size
+        latency *= (2 if high_quality else 1) * (self.args.slow_factor if slow else 1)
+        if self.args.latency_distribution == "lognormal":
+            sigma = self.args.latency_sigma
+            latency *= self.rng.lognormvariate(-(sigma**2) / 2, sigma)
+        elif self.args.latency_distribution == "exponential":
+            latency *= self.rng.expovariate(1.0)
+        return latency
+
+    async def start(self):
+        for index in range(self.args.num_servers):
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            runner = web.AppRunner(self._server_app(url, slow=index < self.args.slow_servers))
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+            self.urls.append(url)
+            self._runners.append(runner)
+
+    async def stop(self):
+        for runner in self._runners:
+            await runner.cleanup()
+
+    def _server_app(self, url: str, slow: bool) -> web.Application:
+        slots = asyncio.Semaphore(self.args.server_concurrency)
+
+        async def ready(request):
+            self.probed.add(url)
+            return web.json_response({})
+
+        async def predict(request):
+            batch = (await request.json())["batch"]
+            now = time.monotonic()
+            for item in batch:
+                self.received.setdefault(item["prompt"], now)
+            async with slots:
+                self.batch_sizes.append(len(batch))
+                await asyncio.sleep(self.batch_latency(len(batch), batch[0]["high_quality"], slow))
+                if self.rng.random() < self.args.failure_rate:
+                    return web.json_response({"detail": "simulated failure"}, status=500)
+            return web.json_response([{"image": "data:image/png;base64,"} for _ in batch])
+
+        app = web.Application()
+        app.router.add_get("/api/ready", ready)
+        app.router.add_get("/api/health", ready)
+        app.router.add_post("/api/predict", predict)
+        return app
+
+
+async def wait_for_load_balancer(url: str, fleet: FakeFleet, timeout: float = 60):
+    """Waits until the load balancer answers and has probed every server, so that it routes to all of them."""
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f"{url}/num-requests") as response:
+                    if response.status == 200 and len(fleet.probed) == len(fleet.urls):
+                        return
+            except aiohttp.ClientConnectionError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"the load balancer at {url} did not start")
+
+
+async def send_requests(url: str, args) -> List[dict]:
+    rng = random.Random(args.seed)
+    results = []
+
+    async def send(session: aiohttp.ClientSession, data: Data):
+        start_time = time.monotonic()
+        try:
+            async with session.post(f"{url}/api/predict", json=data.dict()) as response:
+                await response.read()
+                status = str(response.status)
+        except Exception as e:
+            status = type(e).__name__
+        results.append({"prompt": data.prompt, "start": start_time, "end": time.monotonic(), "status": status})
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        tasks = []
+        for i in range(args.num_requests):
+            data = Data(prompt=f"benchmark prompt {i}", high_quality=rng.random() < args.high_quality_ratio)
+            tasks.append(asyncio.create_task(send(session, data)))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+    return results
+
+
+async def measure(fleet: FakeFleet, max_batch_size: int, batch_timeout_secs: float, args) -> dict:
+    fleet.reset()
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_load_balancer, args=(port, fleet.urls, max_batch_size, batch_timeout_secs), daemon=True
+    )
+    process.start()
+    try:
+        await wait_for_load_balancer(url, fleet)
+        results = await send_requests(url, args)
+    finally:
+        process.terminate()
+        process.join()
+
+    completed = [result for result in results if result["status"] == "200"]
+    errors: Dict[str, int] = {}
+    for result in results:
+        if result["status"] != "200":
+            errors[result["status"]] = errors.get(result["status"], 0) + 1
+    wall_time = max(result["end"] for result in results) - min(result["start"] for result in results)
+    queueing_delays = [
+        fleet.received[result["prompt"]] - result["start"] for result in results if result["prompt"] in fleet.received
+    ]
+    return {
+        "max_batch_size": max_batch_size,
+        "batch_timeout_secs": batch_timeout_secs,
+        "requests": len(results),
+        "completed": len(completed),
+        "errors": errors,
+        "throughput": len(completed) / wall_time,
+        "latency": percentiles([result["end"] - result["start"] for result in completed]),
+        "queueing_delay": percentiles(queueing_delays),
+        "batches": len(fleet.batch_sizes),
+        "fill_ratio": statistics.mean(fleet.batch_sizes) / max_batch_size if fleet.batch_sizes else 0.0,
+    }
+
+
+def relative_change(value: Optional[float], baseline: Optional[float]) -> str:
+    if value is None or not baseline:
+        return "   n/a"
+    return f"{(value - baseline) / baseline * 100:+6.1f}%"
+
+
+def compare(runs: List[dict], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {(run["max_batch_size"], run["batch_timeout_secs"]): run for run in json.load(f)["runs"]}
+    print(f"change against {baseline_path}:")
+    for run in runs:
+        base = baseline.get((run["max_batch_size"], run["batch_timeout_secs"]))
+        if base is None:
+            continue
+        print(
+            f"batch_size={run['max_batch_size']:>3} timeout={run['batch_timeout_secs']:>5}s: "
+            f"throughput {relative_change(run['throughput'], base['throughput'])} "
+            f"p50 {relative_change(run['latency']['p50'], base['latency']['p50'])} "
+            f"p95 {relative_change(run['latency']['p95'], base['latency']['p95'])} "
+            f"p99 {relative_change(run['latency']['p99'], base['latency']['p99'])} "
+            f"fill_ratio {relative_change(run['fill_ratio'], base['fill_ratio'])}"
+        )
+
+
+def print_run(run: dict):
+    latency, queueing_delay = run["latency"], run["queueing_delay"]
+
+    def secs(value: Optional[float]) -> str:
+        return "     n/a" if value is None else f"{value:7.2f}s"
+
+    print(
+        f"batch_size={run['max_batch_size']:>3} timeout={run['batch_timeout_secs']:>5}s: "
+        f"throughput={run['throughput']:6.2f}/s p50={secs(latency['p50'])} p95={secs(latency['p95'])} "
+        f"p99={secs(latency['p99'])} queueing_p95={secs(queueing_delay['p95'])} "
+        f"fill_ratio={run['fill_ratio']:.2f} errors={sum(run['errors'].values())}"
+    )
+
+
+async def benchmark(args) -> List[dict]:
+    fleet = FakeFleet(args)
+    await fleet.start()
+    runs = []
+    try:
+        for max_batch_size, batch_timeout_secs in itertools.product(args.batch_sizes, args.batch_timeouts):
+            run = await measure(fleet, max_batch_size, batch_timeout_secs, args)
+            print_run(run)
+            runs.append(run)
+    finally:
+        await fleet.stop()
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-servers", type=int, default=4)
+    parser.add_argument("--num-requests", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=8.0, help="requests per second")
+    parser.add_argument("--high-quality-ratio", type=float, default=0.1)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[4, 8, 12])
+    parser.add_argument("--batch-timeouts", type=float, nargs="+", default=[0.5, 2.0])
+    parser.add_argument("--latency-base", type=float, default=1.0, help="seconds per batch")
+    parser.add_argument("--latency-per-image", type=float, default=0.25, help="seconds per image of a batch")
+    parser.add_argument("--latency-distribution", choices=["constant", "lognormal", "exponential"], default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.25, help="sigma of the lognormal distribution")
+    parser.add_argument("--slow-servers", type=int, default=0)
+    parser.add_argument("--slow-factor", type=float, default=2.0)
+    parser.add_argument("--server-concurrency", type=int, default=1, help="batches processed at once by a server")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability of a batch failing")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    # the benchmark clients are not rate limited
+    os.environ["MUSE_LOAD_TESTING"] = "1"
+    runs = asyncio.run(benchmark(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "runs": runs}, f, indent=2)
+    if args.compare:
+        compare(runs, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import contextlib
+import threading
+import time
+
+import pytest
+import torch
+
+from muse.pipeline import ConditioningCache, ContinuousBatcher, StableDiffusionModel
+from muse.pipeline.preview import latent_preview
+from muse.pipeline.sampling import SAMPLERS, SamplingCancelled, ddim_timesteps, sample_ddim
+
+
+class FakeLatentDiffusion(torch.nn.Module):
+    """Stands in for the ldm model: a cheap UNet and VAE with the same tensor shapes."""
+
+    def __init__(self, step_delay: float = 0.0):
+        super().__init__()
+        self.step_delay = step_delay
+        self.register_buffer("alphas_cumprod", torch.linspace(0.9999, 0.01, 1000))
+        self.encoded_prompts = []
+
+    @property
+    def device(self):
+        return self.alphas_cumprod.device
+
+    def apply_model(self, x, t, c):
+        time.sleep(self.step_delay)
+        return 0.1 * x + c.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+
+    def get_learned_conditioning(self, prompts):
+        self.encoded_prompts.append(list(prompts))
+        return torch.stack([torch.full((77, 8), float(len(prompt))) for prompt in prompts])
+
+    def decode_first_stage(self, z):
+        return torch.nn.functional.interpolate(torch.tanh(z[:, :3]), scale_factor=8)
+
+    @contextlib.contextmanager
+    def ema_scope(self):
+        yield
+
+
+class FakeModel:
+    autocast = StableDiffusionModel.autocast
+    decode_to_tensor = StableDiffusionModel.decode_to_tensor
+    cpu_precision = None
+
+    def __init__(self, step_delay: float = 0.0):
+        self.model = FakeLatentDiffusion(step_delay)
+        self.conditioning = ConditioningCache(self.model)
+        self.device = torch.device("cpu")
+
+
+def test_ddim_timesteps_match_ddim_sampler():
+    assert ddim_timesteps(50) == list(range(981, 0, -20))
+    assert len(ddim_timesteps(25)) == 25
+
+
+def test_short_request_joins_and_leaves_before_long_request():
+    batcher = ContinuousBatcher(FakeModel(step_delay=0.01), max_running=4, height=32, width=32)
+    batcher.start()
+    try:
+        long_request = batcher.submit("a long and detailed prompt", 50)
+        time.sleep(0.1)
+        short_request = batcher.submit("short prompt", 25)
+
+        image = short_request.result(timeout=10)
+        assert not long_request.done()
+        assert long_request.result(timeout=10).shape == image.shape == (3, 32, 32)
+    finally:
+        batcher.stop()
+
+
+def test_decode_error_fails_the_finished_samples():
+    class FailingDecodeModel(FakeModel):
+        def decode_to_tensor(self, samples):
+            raise RuntimeError("CUDA out of memory")
+
+    batcher = ContinuousBatcher(FailingDecodeModel(), max_running=4, height=32, width=32)
+    batcher.start()
+    try:
+        requests = [batcher.submit("a prompt", 5), batcher.submit("another prompt", 5)]
+        for request in requests:
+            with pytest.raises(RuntimeError, match="out of memory"):
+                request.result(timeout=10)
+        assert batcher._thread.is_alive()
+    finally:
+        batcher.stop()
+
+
+def test_step_callback_sees_every_step_of_its_sample_and_can_cancel():
+    batcher = ContinuousBatcher(FakeModel(), max_running=2, height=32, width=32)
+    steps = []
+
+    def on_step(step, pred_x0):
+        steps.append((step, tuple(pred_x0.shape)))
+        if step == 3:
+            raise SamplingCancelled()
+
+    batcher.start()
+    try:
+        cancelled_request = batcher.submit("a prompt", 10, callback=on_step)
+        other_request = batcher.submit("another prompt", 10)
+        with pytest.raises(SamplingCancelled):
+            cancelled_request.result(timeout=10)
+        assert other_request.result(timeout=10).shape == (3, 32, 32)
+        assert steps == [(step, (1, 4, 4, 4)) for step in (1, 2, 3)]
+        assert batcher.cancelled_samples == 1
+    finally:
+        batcher.stop()
+
+
+def test_mixed_step_batch_matches_separate_batches():
+    model = FakeLatentDiffusion()
+    prompts = ["a low quality prompt", "a high quality prompt"]
+    cond = model.get_learned_conditioning(prompts)
+    uncond = model.get_learned_conditioning(["", ""])
+    x_T = torch.randn((2, 4, 4, 4))
+
+    mixed = sample_ddim(model, cond, uncond, [25, 50], (4, 4, 4), 7.5, x_T=x_T)
+    low = sample_ddim(model, cond[:1], uncond[:1], [25], (4, 4, 4), 7.5, x_T=x_T[:1])
+    high = sample_ddim(model, cond[1:], uncond[1:], [50], (4, 4, 4), 7.5, x_T=x_T[1:])
+    assert torch.allclose(mixed, torch.cat([low, high]))
+
+
+def test_conditioning_cache_encodes_only_missing_prompts():
+    model = FakeLatentDiffusion()
+    cache = ConditioningCache(model, max_prompts=2)
+
+    first = cache.get(["a", "bb", "a"])
+    second = cache.get(["bb", "ccc"])
+    cache.unconditional(4)
+    cache.unconditional(2)
+
+    assert model.encoded_prompts == [["a", "bb"], ["ccc"], [""]]
+    assert torch.equal(first[0], first[2]) and torch.equal(first[1], second[0])
+    assert cache.unconditional(3).shape == (3, 77, 8)
+    assert cache.stats() == {"hits": 1, "misses": 4, "evictions": 1, "hit_rate": 0.2, "size": 2}
+    # the cached embeddings do not keep the encoded batch alive
+    assert all(e.untyped_storage().nbytes() == e.nbytes for e in cache._prompts.values())
+
+
+def test_sampling_callback_sees_every_step_and_can_cancel():
+    model = FakeLatentDiffusion()
+    cond = model.get_learned_conditioning(["a prompt"])
+    uncond = model.get_learned_conditioning([""])
+    steps = []
+
+    def callback(step, pred_x0):
+        assert pred_x0.shape == (1, 4, 4, 4)
+        steps.append(step)
+        if step == 10:
+            raise SamplingCancelled()
+
+    with pytest.raises(SamplingCancelled):
+        sample_ddim(model, cond, uncond, [25], (4, 4, 4), 7.5, callback=callback)
+    assert steps == list(range(1, 11))
+
+
+def test_latent_preview_is_an_image_at_latent_resolution():
+    preview = latent_preview(torch.randn((2, 4, 8, 8)))
+    assert preview.shape == (2, 3, 8, 8)
+    assert preview.min() >= 0 and preview.max() <= 1
+
+
+def test_cancelled_samples_leave_the_running_set():
+    batcher = ContinuousBatcher(FakeModel(step_delay=0.01), max_running=1, height=32, width=32)
+    batcher.start()
+    try:
+        cancelled = threading.Event()
+        dead_request = batcher.submit("nobody waits for this one", 50, cancelled=cancelled)
+        expired_request = batcher.submit("nor for this one", 50, deadline=time.time() + 0.1)
+        live_request = batcher.submit("a live prompt", 25)
+        time.sleep(0.1)
+        cancelled.set()
+
+        # the single slot is freed for the live request long before the dead ones would have finished
+        assert live_request.result(timeout=1).shape == (3, 32, 32)
+        with pytest.raises(SamplingCancelled):
+            dead_request.result(timeout=1)
+        with pytest.raises(SamplingCancelled):
+            expired_request.result(timeout=1)
+        assert batcher.cancelled_samples == 2
+    finally:
+        batcher.stop()
+
+
+class ExactDenoiser(FakeLatentDiffusion):
+    """Predicts the exact noise between its input and a fixed image."""
+
+    def __init__(self, x0):
+        super().__init__()
+        self.x0 = x0
+
+    def apply_model(self, x, t, c):
+        a_t = self.alphas_cumprod[t].view(-1, 1, 1, 1)
+        return (x - a_t.sqrt() * self.x0.repeat(len(x) // len(self.x0), 1, 1, 1)) / (1 - a_t).sqrt()
+
+
+@pytest.mark.parametrize("sampler", SAMPLERS)
+def test_samplers_converge_to_the_denoised_image(sampler):
+    x0 = torch.randn((1, 4, 4, 4))
+    model = ExactDenoiser(x0)
+    cond = model.get_learned_conditioning(["a prompt"])
+    uncond = model.get_learned_conditioning([""])
+
+    image = sample_ddim(model, cond, uncond, [15], (4, 4, 4), 7.5, samplers=[sampler])
+
+    # DDIM stops at the first training timestep with a little noise left, the other samplers remove all of it
+    assert torch.allclose(image, x0, atol=5e-2 if sampler == "ddim" else 1e-4)
+
+
+def test_mixed_sampler_batch_matches_separate_batches():
+    model = FakeLatentDiffusion()
+    cond = model.get_learned_conditioning(["a prompt", "another prompt"])
+    uncond = model.get_learned_conditioning(["", ""])
+    x_T = torch.randn((2, 4, 4, 4))
+
+    mixed = sample_ddim(model, cond, uncond, [20, 15], (4, 4, 4), 7.5, x_T=x_T, samplers=["ddim", "dpmpp_2m"])
+    ddim = sample_ddim(model, cond[:1], uncond[:1], [20], (4, 4, 4), 7.5, x_T=x_T[:1])
+    dpmpp = sample_ddim(model, cond[1:], uncond[1:], [15], (4, 4, 4), 7.5, x_T=x_T[1:], samplers=["dpmpp_2m"])
+    assert torch.allclose(mixed, torch.cat([ddim, dpmpp]))
+
+
+def test_samples_of_different_samplers_share_the_running_set():
+    batcher = ContinuousBatcher(FakeModel(), max_running=4, height=32, width=32)
+    batcher.start()
+    try:
+        futures = [batcher.submit("a prompt", 15, sampler=sampler) for sampler in SAMPLERS]
+        assert all(future.result(timeout=10).shape == (3, 32, 32) for future in futures)
+    finally:
+        batcher.stop()
@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from muse.pipeline.cpu import cpu_autocast, optimize_for_cpu
+
+
+class FakeLatentDiffusion(torch.nn.Module):
+    """Has the three submodules of the ldm model, each with a convolution and a linear layer."""
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        for name in ("model", "cond_stage_model", "first_stage_model"):
+            setattr(
+                self,
+                name,
+                torch.nn.Sequential(
+                    torch.nn.Conv2d(4, 8, 3, padding=1), torch.nn.Flatten(), torch.nn.Linear(8 * 8 * 8, 16)
+                ),
+            )
+
+    def forward(self, x):
+        return self.model(x)
+
+
+@pytest.fixture
+def restore_num_threads():
+    """optimize_for_cpu sizes the global thread pool of torch, the other tests get it back as it was."""
+    num_threads = torch.get_num_threads()
+    yield
+    torch.set_num_threads(num_threads)
+
+
+def test_int8_quantizes_the_linear_layers_of_every_submodule(restore_num_threads):
+    model = FakeLatentDiffusion()
+    x = torch.randn((2, 4, 8, 8))
+    expected = model(x)
+
+    optimize_for_cpu(model, "int8", num_threads=2)
+    assert torch.get_num_threads() == 2
+    assert model.model[0].weight.is_contiguous(memory_format=torch.channels_last)
+    for name in ("model", "cond_stage_model", "first_stage_model"):
+        assert isinstance(getattr(model, name)[2], torch.ao.nn.quantized.dynamic.Linear)
+    assert torch.allclose(model(x), expected, atol=0.05)
+
+
+def test_bf16_runs_under_autocast(restore_num_threads):
+    model = optimize_for_cpu(FakeLatentDiffusion(), "bf16")
+    x = torch.randn((2, 4, 8, 8))
+
+    with cpu_autocast("bf16"):
+        assert model(x).dtype == torch.bfloat16
+    with cpu_autocast(None):
+        assert model(x).dtype == torch.float32
+    assert model.model[2].weight.dtype == torch.float32
+
+
+def test_unknown_precision():
+    with pytest.raises(ValueError, match="Unknown CPU precision"):
+        optimize_for_cpu(FakeLatentDiffusion(), "fp8")
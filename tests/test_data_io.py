@@ -0,0 +1,53 @@
+import pytest
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from muse.utility.data_io import Data, batch_key, decode_data_uri, negotiate_image_format
+
+
+@pytest.mark.parametrize(
+    "accept, image_format",
+    [
+        (None, None),
+        ("application/json", None),
+        ("*/*", None),
+        ("image/png", "png"),
+        ("image/webp, image/png;q=0.9", "webp"),
+        ("image/png;q=0.1, application/json", None),
+        ("application/json;q=0.5, image/*", "png"),
+        ("image/*;q=0.8, image/webp", "webp"),
+        ("image/webp;q=0, image/*", "png"),
+        ("application/json, image/png", None),
+        ("text/html, image/png", "png"),
+        ("text/html, */*;q=0.1", None),
+    ],
+)
+def test_negotiate_image_format(accept, image_format):
+    assert negotiate_image_format(accept) == image_format
+
+
+@pytest.mark.parametrize("accept", ["text/html", "image/png;q=0, application/json;q=0"])
+def test_negotiate_image_format_rejects_unacceptable_types(accept):
+    with pytest.raises(HTTPException) as e:
+        negotiate_image_format(accept)
+    assert e.value.status_code == 406
+
+
+def test_decode_data_uri():
+    assert decode_data_uri("data:image/png;base64,aGVsbG8=") == b"hello"
+
+
+def test_batch_key_separates_samplers_and_step_counts():
+    assert batch_key(Data(prompt="a")) == ("low", "ddim", 25)
+    assert batch_key(Data(prompt="a", high_quality=True)) == ("high", "ddim", 50)
+    assert batch_key(Data(prompt="a", high_quality=True, num_inference_steps=20, sampler="dpmpp_2m")) == (
+        "low",
+        "dpmpp_2m",
+        20,
+    )
+
+
+@pytest.mark.parametrize("fields", [{"num_inference_steps": 0}, {"num_inference_steps": 500}, {"sampler": "plms"}])
+def test_invalid_sampling_options_are_rejected(fields):
+    with pytest.raises(ValidationError):
+        Data(prompt="a", **fields)
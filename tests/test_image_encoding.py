@@ -0,0 +1,35 @@
+import subprocess
+import sys
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from muse.utility.image_encoding import ImageEncoder, encode_image
+
+
+def test_encoder_pool_matches_inline_encoding():
+    arrays = [np.full((16, 16, 3), i * 40, dtype=np.uint8) for i in range(5)]
+    formats = ["png", "webp", "png", "png", "webp"]
+    nsfw = [False, False, True, False, False]
+    encoder = ImageEncoder(processes=2, compress_level=1)
+    try:
+        payloads = encoder.encode(arrays, formats, nsfw)
+    finally:
+        encoder.shutdown()
+
+    for i in (0, 1, 3, 4):
+        assert payloads[i] == encode_image(arrays[i], formats[i], compress_level=1)
+    assert payloads[2] == encoder._placeholders["png"]
+    assert np.array_equal(np.asarray(Image.open(BytesIO(payloads[3]))), arrays[3])
+
+
+def test_compress_level_trades_size_for_speed():
+    array = np.tile(np.arange(256, dtype=np.uint8), (64, 3)).reshape(64, 256, 3)
+    assert len(encode_image(array, "png", compress_level=9)) < len(encode_image(array, "png", compress_level=0))
+
+
+def test_worker_module_does_not_import_the_model_stack():
+    # the spawned encoder processes import this module, they should not load torch and lightning
+    code = "import sys, muse.utility.image_encoding; print(sorted({'torch', 'lightning'} & set(sys.modules)))"
+    assert subprocess.check_output([sys.executable, "-c", code], text=True).strip() == "[]"
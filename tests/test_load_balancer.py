@@ -0,0 +1,354 @@
+import asyncio
+from typing import Optional
+
+import pytest
+from aiohttp import web
+from fastapi import HTTPException
+
+from muse.components.load_balancer import LoadBalancer
+from muse.utility.data_io import Data, LimitBacklogException, format_sse
+from muse.utility.metrics import COALESCE_LOOKUPS
+from muse.utility.result_cache import ResultCache
+
+
+async def start_fake_server(port: int, latency: float = 0.0, ready: Optional[asyncio.Event] = None) -> web.AppRunner:
+    async def is_ready(request):
+        if ready is not None and not ready.is_set():
+            return web.json_response({"detail": "warming up"}, status=503)
+        return web.json_response({})
+
+    async def predict(request):
+        data = await request.json()
+        await asyncio.sleep(latency)
+        return web.json_response([{"image": item["prompt"]} for item in data["batch"]])
+
+    async def stream(request):
+        data = await request.json()
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for step in range(int(request.query["preview_steps"]), 25, int(request.query["preview_steps"])):
+            await response.write(format_sse("preview", {"step": step}).encode())
+        await response.write(format_sse("result", {"image": data["prompt"]}).encode())
+        return response
+
+    app = web.Application()
+    app.router.add_post("/api/predict", predict)
+    app.router.add_post("/api/stream", stream)
+    app.router.add_get("/api/ready", is_ready)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def create_load_balancer(servers, **kwargs) -> LoadBalancer:
+    load_balancer = LoadBalancer(**kwargs)
+    load_balancer.servers = servers
+    load_balancer._router.update_servers(servers)
+    return load_balancer
+
+
+def test_results_are_delivered_to_each_request():
+    async def run():
+        runner = await start_fake_server(8701)
+        load_balancer = create_load_balancer(["http://127.0.0.1:8701"], max_batch_size=4, batch_timeout_secs=0.2)
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            requests = [Data(prompt=f"prompt {i}", high_quality=bool(i % 2)) for i in range(10)]
+            return await asyncio.gather(*[load_balancer.process_request(data) for data in requests])
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    results = asyncio.run(run())
+    assert results == [{"image": f"prompt {i}"} for i in range(10)]
+
+
+def test_full_batch_is_sent_without_waiting_for_timeout():
+    async def run():
+        runner = await start_fake_server(8702)
+        load_balancer = create_load_balancer(["http://127.0.0.1:8702"], max_batch_size=4, batch_timeout_secs=60)
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            requests = [load_balancer.process_request(Data(prompt=f"prompt {i}")) for i in range(4)]
+            return await asyncio.wait_for(asyncio.gather(*requests), timeout=5)
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    assert len(asyncio.run(run())) == 4
+
+
+def test_connections_are_reused_across_batches():
+    async def run():
+        runner = await start_fake_server(8703)
+        server = "http://127.0.0.1:8703"
+        load_balancer = create_load_balancer([server], max_batch_size=1, batch_timeout_secs=60)
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            await load_balancer.process_request(Data(prompt="first"))
+            session = load_balancer._sessions[server]
+            await load_balancer.process_request(Data(prompt="second"))
+            return session is load_balancer._sessions[server]
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    assert asyncio.run(run())
+
+
+def test_failed_batch_is_sent_to_another_server():
+    async def run():
+        runner = await start_fake_server(8704)
+        dead_server, server = "http://127.0.0.1:8799", "http://127.0.0.1:8704"
+        load_balancer = create_load_balancer([dead_server, server], max_batch_size=1, batch_timeout_secs=60)
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            results = [await load_balancer.process_request(Data(prompt=f"prompt {i}")) for i in range(4)]
+            return results, load_balancer._router.ejected_servers
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    results, ejected_servers = asyncio.run(run())
+    assert results == [{"image": f"prompt {i}"} for i in range(4)]
+    assert ejected_servers == ["http://127.0.0.1:8799"]
+
+
+def test_request_is_rejected_when_backlog_exceeds_deadline():
+    server = "http://127.0.0.1:8705"
+    load_balancer = create_load_balancer([server], max_batch_size=4)
+    load_balancer._router.stats[server].observe("low", 60.0)
+    load_balancer._router.stats[server].in_flight["low"] = 1
+    load_balancer.admit_request(Data(prompt="fits in the deadline"))
+
+    load_balancer._router.stats[server].in_flight["low"] = 2
+    with pytest.raises(LimitBacklogException) as excinfo:
+        load_balancer.admit_request(Data(prompt="too late"))
+    assert excinfo.value.status_code == 503
+    assert excinfo.value.headers == {"Retry-After": "20"}
+
+
+def test_slow_batch_is_hedged_on_another_server():
+    async def run():
+        slow_runner = await start_fake_server(8706, latency=3)
+        fast_runner = await start_fake_server(8707)
+        servers = ["http://127.0.0.1:8706", "http://127.0.0.1:8707"]
+        load_balancer = create_load_balancer(
+            servers, max_batch_size=1, routing_policy="round_robin", hedge_latency_factor=2
+        )
+        for server in servers:
+            load_balancer._router.stats[server].observe("low", 0.1)
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            return await asyncio.wait_for(load_balancer.process_request(Data(prompt="hedged")), timeout=2)
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await slow_runner.cleanup()
+            await fast_runner.cleanup()
+
+    assert asyncio.run(run()) == {"image": "hedged"}
+
+
+def test_identical_prompts_are_coalesced():
+    async def run():
+        runner = await start_fake_server(8708)
+        load_balancer = create_load_balancer(["http://127.0.0.1:8708"], max_batch_size=4, batch_timeout_secs=0.2)
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            prompts = ["Cats in hats", "cats  in hats", "dogs in hats"]
+            results = await asyncio.gather(*[load_balancer.process_request(Data(prompt=p)) for p in prompts])
+            return results, load_balancer._coalesced
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    results, coalesced = asyncio.run(run())
+    assert results == [{"image": "Cats in hats"}, {"image": "Cats in hats"}, {"image": "dogs in hats"}]
+    assert coalesced == {}
+
+
+def test_coalescing_can_be_disabled():
+    async def run():
+        runner = await start_fake_server(8714)
+        load_balancer = create_load_balancer(
+            ["http://127.0.0.1:8714"], max_batch_size=4, batch_timeout_secs=0.2, coalesce_requests=False
+        )
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            prompts = ["Cats in hats", "cats  in hats"]
+            return await asyncio.gather(*[load_balancer.process_request(Data(prompt=p)) for p in prompts])
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    lookups = COALESCE_LOOKUPS._value.get()
+    assert asyncio.run(run()) == [{"image": "Cats in hats"}, {"image": "cats  in hats"}]
+    # the lookups only count the requests that could have been coalesced
+    assert COALESCE_LOOKUPS._value.get() == lookups
+
+
+def test_repeated_request_is_answered_from_the_result_cache(monkeypatch):
+    batches = []
+    send_batch = LoadBalancer.send_batch
+
+    async def counting_send_batch(self, batch):
+        batches.append(batch)
+        await send_batch(self, batch)
+
+    monkeypatch.setattr(LoadBalancer, "send_batch", counting_send_batch)
+
+    async def run():
+        runner = await start_fake_server(8715)
+        load_balancer = create_load_balancer(["http://127.0.0.1:8715"], max_batch_size=4, batch_timeout_secs=0.1)
+        load_balancer._result_cache = ResultCache(memory_bytes=2**20)
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            first = await load_balancer.process_request(Data(prompt="Cats in hats"))
+            await asyncio.sleep(0.1)  # the result is written to the cache by a callback of the request's future
+            second = await load_balancer.process_request(Data(prompt="cats in  hats"))
+            return first, second
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    first, second = asyncio.run(run())
+    assert first == second == {"image": "Cats in hats"}
+    assert len(batches) == 1
+
+
+def test_stream_is_proxied_from_the_server():
+    async def run():
+        runner = await start_fake_server(8709)
+        server = "http://127.0.0.1:8709"
+        load_balancer = create_load_balancer([server])
+        try:
+            events = await load_balancer.stream_request(Data(prompt="a prompt"), preview_steps=10)
+            assert load_balancer._router.stats[server].in_flight["low"] == 1
+            body = b"".join([chunk async for chunk in events])
+            return body.decode(), load_balancer._router.stats[server].in_flight["low"]
+        finally:
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    body, in_flight = asyncio.run(run())
+    expected = [format_sse("preview", {"step": 10}), format_sse("preview", {"step": 20})]
+    assert body == "".join(expected + [format_sse("result", {"image": "a prompt"})])
+    assert in_flight == 0
+
+
+
+
+def test_rejected_batch_forwards_the_server_error():
+    async def rejected(request):
+        return web.json_response({"detail": "unsupported sampler"}, status=422)
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/api/predict", rejected)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 8713).start()
+        server = "http://127.0.0.1:8713"
+        load_balancer = create_load_balancer([server], batch_timeout_secs=0.1)
+        consumer = asyncio.create_task(load_balancer.consumer())
+        try:
+            with pytest.raises(HTTPException) as error:
+                await load_balancer.process_request(Data(prompt="a prompt", sampler="euler_a"))
+            return error.value, load_balancer._router.ejected_servers
+        finally:
+            consumer.cancel()
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    error, ejected_servers = asyncio.run(run())
+    assert (error.status_code, error.detail) == (422, "unsupported sampler")
+    assert ejected_servers == []
+
+
+def test_rejected_stream_forwards_the_server_error():
+    async def rejected(request):
+        return web.json_response({"detail": "Model Server has too much backlog."}, status=503)
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/api/stream", rejected)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 8712).start()
+        server = "http://127.0.0.1:8712"
+        load_balancer = create_load_balancer([server])
+        try:
+            with pytest.raises(HTTPException) as error:
+                await load_balancer.stream_request(Data(prompt="a prompt"), preview_steps=10)
+            return error.value, load_balancer._router.stats[server].in_flight["low"]
+        finally:
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            await runner.cleanup()
+
+    error, in_flight = asyncio.run(run())
+    assert (error.status_code, error.detail) == (503, "Model Server has too much backlog.")
+    assert in_flight == 0
+
+
+def test_batches_are_routed_to_ready_servers_only():
+    async def run():
+        warm = asyncio.Event()
+        runners = [await start_fake_server(8710), await start_fake_server(8711, ready=warm)]
+        servers = ["http://127.0.0.1:8710", "http://127.0.0.1:8711"]
+        load_balancer = LoadBalancer(max_batch_size=1, batch_timeout_secs=0.01)
+        load_balancer._router.update_servers(servers, ready=False)
+        try:
+            await load_balancer.probe_servers()
+            assert load_balancer._router.available_servers() == servers[:1]
+            assert load_balancer._router.warming_servers == servers[1:]
+
+            warm.set()
+            await load_balancer.probe_servers()
+            return load_balancer._router.available_servers()
+        finally:
+            await load_balancer._close_sessions(list(load_balancer._sessions))
+            for runner in runners:
+                await runner.cleanup()
+
+    assert asyncio.run(run()) == ["http://127.0.0.1:8710", "http://127.0.0.1:8711"]
+
+
+def test_only_compatible_requests_are_batched_together():
+    async def run():
+        load_balancer = LoadBalancer()
+        for data in [
+            Data(prompt="a"),
+            Data(prompt="b", num_inference_steps=25),
+            Data(prompt="c", sampler="euler_a"),
+            Data(prompt="d", num_inference_steps=15, sampler="dpmpp_2m"),
+            Data(prompt="e", num_inference_steps=15, sampler="dpmpp_2m"),
+        ]:
+            load_balancer._enqueue(data)
+        return {key: [request[1]["prompt"] for request in queue] for key, queue in load_balancer._batch.items()}
+
+    assert asyncio.run(run()) == {
+        ("low", "ddim", 25): ["a", "b"],
+        ("low", "euler_a", 25): ["c"],
+        ("low", "dpmpp_2m", 15): ["d", "e"],
+    }
+
+
+def test_requests_are_asked_to_retry_while_the_fleet_warms_up():
+    load_balancer = LoadBalancer()
+    load_balancer.servers = ["http://127.0.0.1:8799"]
+    load_balancer._router.update_servers(load_balancer.servers, ready=False)
+
+    for request in (load_balancer.process_request(Data(prompt="a")), load_balancer.stream_request(Data(prompt="a"), 5)):
+        with pytest.raises(LimitBacklogException) as error:
+            asyncio.run(request)
+        assert error.value.status_code == 503
+        assert error.value.headers["Retry-After"] == str(load_balancer.health_check_interval)
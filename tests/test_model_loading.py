@@ -0,0 +1,60 @@
+import sys
+import threading
+import types
+
+import pytest
+import torch
+
+from muse.pipeline.model import load_model_from_config, load_state_dict, skip_weight_init
+
+
+def build_model():
+    return torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.LayerNorm(4))
+
+
+@pytest.fixture
+def fake_ldm(monkeypatch):
+    util = types.SimpleNamespace(instantiate_from_config=lambda config: build_model())
+    monkeypatch.setitem(sys.modules, "ldm", types.SimpleNamespace(util=util))
+    monkeypatch.setitem(sys.modules, "ldm.util", util)
+
+
+def test_model_is_built_with_the_checkpoint_weights(fake_ldm, tmp_path):
+    state_dict = build_model().state_dict()
+    torch.save({"state_dict": state_dict, "global_step": 1}, tmp_path / "model.ckpt")
+    timings = {}
+
+    model = load_model_from_config(types.SimpleNamespace(model=None), str(tmp_path / "model.ckpt"), timings=timings)
+
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(tensor, state_dict[name])
+    assert set(timings) == {"deserialize", "instantiate", "load weights"}
+
+
+def test_safetensors_checkpoint_is_loaded(tmp_path):
+    safetensors = pytest.importorskip("safetensors.torch")
+    state_dict = build_model().state_dict()
+    safetensors.save_file(state_dict, tmp_path / "model.safetensors")
+
+    loaded = load_state_dict(str(tmp_path / "model.safetensors"))
+
+    assert loaded.keys() == state_dict.keys()
+    assert all(torch.equal(loaded[name], tensor) for name, tensor in state_dict.items())
+
+
+def test_weight_init_is_restored_after_the_block():
+    reset_parameters = torch.nn.Linear.reset_parameters
+    with skip_weight_init():
+        assert torch.nn.Linear.reset_parameters is not reset_parameters
+    assert torch.nn.Linear.reset_parameters is reset_parameters
+
+
+def test_weight_init_is_only_skipped_in_the_calling_thread(monkeypatch):
+    initialized_in = []
+    monkeypatch.setattr(torch.nn.Linear, "reset_parameters", lambda layer: initialized_in.append(threading.get_ident()))
+    with skip_weight_init():
+        torch.nn.Linear(4, 4)
+        thread = threading.Thread(target=torch.nn.Linear, args=(4, 4))
+        thread.start()
+        thread.join()
+    assert initialized_in == [thread.ident]
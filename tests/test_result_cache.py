@@ -0,0 +1,42 @@
+from muse.utility.data_io import Data
+from muse.utility.result_cache import DiskStore, MemoryLRU, ResultCache, cache_key
+
+
+def test_cache_key_ignores_case_and_whitespace():
+    assert cache_key(Data(prompt="Cats in  hats")) == cache_key(Data(prompt="cats in hats"))
+    assert cache_key(Data(prompt="cats in hats")) != cache_key(Data(prompt="cats in hats", high_quality=True))
+
+
+def test_memory_lru_is_bounded_by_bytes():
+    lru = MemoryLRU(max_bytes=10)
+    lru.put("a", b"1234")
+    lru.put("b", b"1234")
+    lru.get("a")
+    lru.put("c", b"1234")
+    assert lru.get("b") is None
+    assert lru.get("a") == b"1234" and lru.get("c") == b"1234"
+    assert lru.num_bytes == 8
+
+
+def test_disk_store_evicts_oldest_segment_and_survives_restart(tmp_path):
+    store = DiskStore(str(tmp_path), max_bytes=400, num_segments=4)
+    for i in range(20):
+        store.put(f"key {i}", bytes(40))
+    assert store.get("key 0") is None
+    assert store.get("key 19") == bytes(40)
+    assert store.num_bytes <= 400
+
+    restarted = DiskStore(str(tmp_path), max_bytes=400, num_segments=4)
+    assert restarted.get("key 19") == bytes(40)
+    assert restarted.get("key 0") is None
+
+
+def test_result_cache_promotes_disk_hits_to_memory(tmp_path):
+    cache = ResultCache(memory_bytes=100, disk_path=str(tmp_path), disk_bytes=10_000)
+    result = {"image": "data:image/png;base64,AAAA"}
+    cache.put("key", result)
+    cache.memory = MemoryLRU(100)
+
+    assert cache.get("key") == result
+    assert cache.memory.get("key") is not None
+    assert cache.get("missing") is None
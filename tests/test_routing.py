@@ -0,0 +1,93 @@
+import pytest
+
+from muse.utility.routing import NoServerAvailable, Router
+
+SERVERS = ["http://server-0", "http://server-1", "http://server-2"]
+
+
+def test_round_robin_cycles_through_servers():
+    router = Router("round_robin")
+    router.update_servers(SERVERS)
+    assert [router.acquire("low") for _ in range(4)] == SERVERS + SERVERS[:1]
+
+
+def test_least_outstanding_avoids_busy_servers():
+    router = Router("least_outstanding")
+    router.update_servers(SERVERS)
+    busy = router.acquire("low")
+    assert busy not in {router.acquire("low"), router.acquire("low")}
+
+
+def test_expected_completion_prefers_faster_server():
+    router = Router("expected_completion")
+    router.update_servers(SERVERS[:2])
+    router.stats[SERVERS[0]].observe("high", 22.0)
+    router.stats[SERVERS[1]].observe("high", 5.0)
+
+    # the fast server takes batches until its queued work outweighs the slow server
+    assert [router.acquire("high") for _ in range(4)] == [SERVERS[1]] * 4
+    assert router.acquire("high") == SERVERS[0]
+
+    router.release(SERVERS[1], "high", latency=5.0)
+    assert router.stats[SERVERS[1]].in_flight["high"] == 3
+
+
+def test_removed_servers_are_not_selected():
+    router = Router()
+    router.update_servers(SERVERS)
+    server = router.acquire("low")
+    router.update_servers(SERVERS[1:])
+    router.release(server, "low", latency=1.0)
+    assert all(router.acquire("low") in SERVERS[1:] for _ in range(5))
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError, match="Unknown routing policy"):
+        Router("random")
+
+
+def test_acquire_without_available_server():
+    router = Router()
+    router.update_servers(SERVERS[:1])
+    with pytest.raises(NoServerAvailable):
+        router.acquire("low", exclude=SERVERS[:1])
+
+
+def test_circuit_breaker_ejects_and_readmits_server():
+    now = [0.0]
+    router = Router(failure_threshold=2, ejection_secs=10, clock=lambda: now[0])
+    router.update_servers(SERVERS[:2])
+    dead, alive = SERVERS[:2]
+
+    for _ in range(2):
+        router.release(router.acquire("low", exclude=[alive]), "low", failed=True)
+    assert router.available_servers() == [alive]
+    assert router.ejected_servers == [dead]
+
+    # after the ejection period a single trial batch is let through
+    now[0] = 11.0
+    assert router.acquire("low", exclude=[alive]) == dead
+    assert router.available_servers() == [alive]
+
+    # a failed trial doubles the ejection period
+    router.release(dead, "low", failed=True)
+    now[0] = 25.0
+    assert router.available_servers() == [alive]
+    now[0] = 32.0
+    router.release(router.acquire("low", exclude=[alive]), "low", latency=1.0)
+    assert router.available_servers() == SERVERS[:2]
+    assert router.ejected_servers == []
+
+
+def test_servers_receive_batches_once_ready():
+    router = Router()
+    router.update_servers(SERVERS[:1])
+    router.update_servers(SERVERS, ready=False)
+    assert router.available_servers() == SERVERS[:1]
+    assert router.warming_servers == SERVERS[1:]
+
+    # a server still warming up answers its probes without becoming ready
+    router.record_probe(SERVERS[1], True, ready=False)
+    router.record_probe(SERVERS[2], True, ready=True)
+    assert router.available_servers() == [SERVERS[0], SERVERS[2]]
+    assert router.ejected_servers == []
@@ -0,0 +1,329 @@
+import sys
+import threading
+import time
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+import torch
+from fastapi import HTTPException
+from PIL import Image
+
+from muse.CONST import INFERENCE_REQUEST_TIMEOUT
+from muse.components.stable_diffusion_serve import SafetyChecker, StableDiffusionServe
+from muse.pipeline.sampling import SamplingCancelled
+from muse.utility.data_io import Data, TimeoutException, decode_data_uri
+from muse.utility.image_encoding import ImageEncoder
+
+
+class FakeText2Image:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompts, image_size, inference_steps):
+        self.calls.append((prompts, inference_steps))
+        images = [Image.new("RGB", (8, 8), color=(len(prompt), inference_steps, 0)) for prompt in prompts]
+        return images[0] if len(images) == 1 else images
+
+
+class FakeStepModel:
+    """Stands in for the in-repo StableDiffusionModel, which takes one step count per prompt, calls the step callback
+    without denoising anything."""
+
+    def __init__(self):
+        self.calls = []
+        self.last_step = 0
+        self.step_delay = 0.0
+        self.on_step = lambda step: None
+        self.running = 0
+        self.max_running = 0
+
+    def predict_step(
+        self, prompts, batch_idx, height, width, num_inference_steps, callback=None, sampler="ddim", output_type="pil"
+    ):
+        self.calls.append((prompts, num_inference_steps, sampler))
+        assert output_type == "tensor"
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        steps = num_inference_steps if isinstance(num_inference_steps, list) else [num_inference_steps] * len(prompts)
+        for step in range(1, max(steps) + 1):
+            self.last_step = step
+            self.on_step(step)
+            time.sleep(self.step_delay)
+            if callback is not None:
+                callback(step, torch.zeros((len(prompts), 4, 2, 2)))
+        self.running -= 1
+        pixels = torch.tensor([[len(prompt), s, 0] for prompt, s in zip(prompts, steps)]) / 255.0
+        return pixels.view(-1, 3, 1, 1).expand(-1, 3, 8, 8)
+
+
+class FakeSafetyChecker:
+    """Flags the images whose red channel is 3 and the prompts asking for something blocked."""
+
+    def __call__(self, images):
+        return [round(float(image[0, 0, 0]) * 255) == 3 for image in images]
+
+    def check_prompts(self, prompts, threshold):
+        return ["blocked" in prompt for prompt in prompts]
+
+
+def test_mixed_quality_batch_is_split_by_step_count():
+    serve = StableDiffusionServe()
+    serve._model = FakeText2Image()
+    dreams = [Data(prompt="a", high_quality=True), Data(prompt="bb"), Data(prompt="ccc", high_quality=True)]
+
+    images = serve._predict_grouped(dreams)
+
+    assert serve._model.calls == [(["bb"], 25), (["a", "ccc"], 50)]
+    assert (images[:, :, 0, 0] * 255).round().tolist() == [[1, 50, 0], [2, 25, 0], [3, 50, 0]]
+
+
+def test_mixed_step_counts_share_the_denoising_loop():
+    serve = StableDiffusionServe()
+    serve._model = FakeStepModel()
+    dreams = [Data(prompt="a", high_quality=True), Data(prompt="bb"), Data(prompt="ccc", high_quality=True)]
+
+    images = serve._predict_grouped(dreams)
+
+    assert serve._model.calls == [(["a", "bb", "ccc"], [50, 25, 50], "ddim")]
+    assert (images[:, :, 0, 0] * 255).round().tolist() == [[1, 50, 0], [2, 25, 0], [3, 50, 0]]
+
+
+def test_stages_compose_into_predict():
+    serve = StableDiffusionServe()
+    serve._model = FakeText2Image()
+    serve._safety_checker = FakeSafetyChecker()
+    serve._encoder = ImageEncoder(processes=0)
+    dreams = [Data(prompt="a"), Data(prompt="bb", image_format="webp"), Data(prompt="ccc")]
+
+    results = serve.predict(dreams, entry_time=time.time())
+
+    assert results[0]["image"].startswith("data:image/png;base64,")
+    assert results[1]["image"].startswith("data:image/webp;base64,")
+    image = Image.open(BytesIO(decode_data_uri(results[0]["image"])))
+    assert image.size == (8, 8) and image.getpixel((0, 0)) == (1, 25, 0)
+    # the NSFW image is replaced by the warning
+    assert Image.open(BytesIO(decode_data_uri(results[2]["image"]))).size == Image.open("assets/nsfw-warning.png").size
+
+
+def test_cancelled_batch_is_not_generated():
+    serve = StableDiffusionServe()
+    serve._model = FakeText2Image()
+    cancelled = threading.Event()
+    cancelled.set()
+
+    with pytest.raises(TimeoutException):
+        serve.generate(([Data(prompt="a")], time.time(), cancelled))
+    assert serve._model.calls == []
+
+
+def test_prompts_are_not_screened_by_default():
+    serve = StableDiffusionServe()
+    serve._safety_checker = FakeSafetyChecker()
+
+    assert serve._screen_prompts([Data(prompt="something blocked")]) == [False]
+    assert serve._screening.to_dict()["screened"] == 0
+
+
+def test_blocked_prompts_are_not_generated():
+    serve = StableDiffusionServe(prompt_safety_threshold=0.9)
+    serve._model = FakeText2Image()
+    serve._safety_checker = FakeSafetyChecker()
+    serve._encoder = ImageEncoder(processes=0)
+    dreams = [Data(prompt="something blocked", high_quality=True), Data(prompt="a")]
+
+    results = serve.predict(dreams, entry_time=time.time())
+    serve.predict([Data(prompt="blocked")], entry_time=time.time())
+
+    assert serve._model.calls == [(["a"], 25)]
+    warning = Image.open(BytesIO(decode_data_uri(results[0]["image"])))
+    assert warning.size == Image.open("assets/nsfw-warning.png").size
+    stats = serve._screening.to_dict()
+    assert stats["screened"] == 3 and stats["blocked"] == 2 and stats["block_rate"] == 2 / 3
+    # the 75 steps of the blocked prompts at the seconds per step of the generated one
+    assert stats["gpu_secs_saved"] == 75 * serve._screening.secs_per_step
+
+
+def test_warmup_runs_every_batch_size_at_every_step_count():
+    serve = StableDiffusionServe(warmup_batch_sizes=[1, 4])
+    serve._model = FakeText2Image()
+    serve._safety_checker = FakeSafetyChecker()
+    serve._encoder = ImageEncoder(processes=0)
+
+    timings = serve.warmup()
+
+    assert [(len(prompts), steps) for prompts, steps in serve._model.calls] == [(1, 25), (1, 50), (4, 25), (4, 50)]
+    assert list(timings) == [
+        "batch of 1 at 25 steps",
+        "batch of 1 at 50 steps",
+        "batch of 4 at 25 steps",
+        "batch of 4 at 50 steps",
+    ]
+    assert serve._ready.is_set()
+    assert serve._screening.to_dict()["screened"] == 0
+
+
+def test_failed_warmup_is_retried_then_reported_unhealthy():
+    serve = StableDiffusionServe(warmup_attempts=2)
+    serve._model = None
+    serve._safety_checker = FakeSafetyChecker()
+
+    with pytest.raises(TypeError):
+        serve.warmup()
+    assert not serve._ready.is_set() and serve._warmup_failed
+    assert serve._warmup_error.startswith("warmup failed")
+
+
+def test_warmup_succeeds_on_a_later_attempt_without_a_deadline(monkeypatch):
+    # any batch with a deadline would time out
+    monkeypatch.setattr("muse.components.stable_diffusion_serve.INFERENCE_REQUEST_TIMEOUT", -1)
+    serve = StableDiffusionServe()
+    serve._safety_checker = FakeSafetyChecker()
+    serve._encoder = ImageEncoder(processes=0)
+    model = FakeText2Image()
+    failures = [RuntimeError("CUDA out of memory")]
+
+    def flaky_model(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return model(*args, **kwargs)
+
+    serve._model = flaky_model
+
+    timings = serve.warmup()
+
+    assert len(timings) == 2 and serve._ready.is_set()
+    assert serve._warmup_error is None and not serve._warmup_failed
+
+
+def create_streaming_serve() -> StableDiffusionServe:
+    serve = StableDiffusionServe()
+    serve._model = FakeStepModel()
+    serve._safety_checker = FakeSafetyChecker()
+    serve._encoder = ImageEncoder(processes=0)
+    return serve
+
+
+def test_stream_emits_previews_then_result():
+    serve = create_streaming_serve()
+    events = []
+
+    serve.stream(Data(prompt="a"), preview_steps=5, emit=lambda event, payload: events.append((event, payload)))
+
+    assert [event for event, _ in events] == ["preview"] * 4 + ["result"]
+    assert [payload["step"] for _, payload in events[:-1]] == [5, 10, 15, 20]
+    assert Image.open(BytesIO(decode_data_uri(events[0][1]["image"]))).size == (2, 2)
+    assert Image.open(BytesIO(decode_data_uri(events[-1][1]["image"]))).size == (8, 8)
+
+
+def test_stream_stops_when_cancelled():
+    serve = create_streaming_serve()
+    cancelled = threading.Event()
+    events = []
+
+    def emit(event, payload):
+        events.append(event)
+        cancelled.set()
+
+    serve.stream(Data(prompt="a"), preview_steps=5, emit=emit, cancelled=cancelled)
+
+    assert events == ["preview"]
+    assert serve._model.last_step == 6
+
+
+def test_streams_and_batches_take_turns_on_the_model():
+    serve = create_streaming_serve()
+    serve._generate_pool = ThreadPoolExecutor(max_workers=1)
+    serve._model.step_delay = 0.002
+    events = []
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        batch = pool.submit(serve.generate, ([Data(prompt="a")], time.time(), None))
+        streams = [pool.submit(serve.stream, Data(prompt=p), 5, lambda *event: events.append(event)) for p in "bc"]
+        assert batch.result()[1].shape == (1, 3, 8, 8)
+        for stream in streams:
+            stream.result()
+
+    assert len(serve._model.calls) == 3 and serve._model.max_running == 1
+    assert [event for event, _ in events].count("result") == 2
+
+
+def test_batch_stops_denoising_once_cancelled():
+    serve = create_streaming_serve()
+    cancelled = threading.Event()
+    serve._model.on_step = lambda step: step == 3 and cancelled.set()
+
+    with pytest.raises(SamplingCancelled):
+        serve.generate(([Data(prompt="a"), Data(prompt="b")], time.time(), cancelled))
+    assert serve._model.last_step == 3
+
+    serve._model.step_delay = 0.01
+    with pytest.raises(SamplingCancelled):
+        serve.generate(([Data(prompt="a")], time.time() - INFERENCE_REQUEST_TIMEOUT + 0.05, None))
+    assert serve._model.last_step < 25
+
+
+def test_continuous_batch_past_its_deadline_times_out():
+    serve = StableDiffusionServe()
+    # a batcher whose samples never finish
+    serve._batcher = types.SimpleNamespace(submit=lambda *args, **kwargs: Future())
+
+    with pytest.raises(TimeoutException):
+        serve._predict_continuous([Data(prompt="a")], deadline=time.time())
+
+
+def test_batch_is_split_by_sampler():
+    serve = create_streaming_serve()
+    dreams = [
+        Data(prompt="a", num_inference_steps=15, sampler="dpmpp_2m"),
+        Data(prompt="b"),
+        Data(prompt="c", num_inference_steps=15, sampler="dpmpp_2m"),
+        Data(prompt="d", sampler="euler_a"),
+    ]
+
+    serve.predict(dreams, entry_time=time.time())
+
+    assert serve._model.calls == [(["b"], [25], "ddim"), (["a", "c"], [15, 15], "dpmpp_2m"), (["d"], [25], "euler_a")]
+
+
+def test_text2image_library_only_accepts_ddim():
+    serve = StableDiffusionServe()
+    serve._model = FakeText2Image()
+
+    serve.validate([Data(prompt="a", num_inference_steps=10)])
+    with pytest.raises(HTTPException) as error:
+        serve.validate([Data(prompt="a"), Data(prompt="b", sampler="euler_a")])
+    assert error.value.status_code == 422
+
+
+class FakeCLIP(torch.nn.Module):
+    dtype = torch.float32
+    visual = types.SimpleNamespace(input_resolution=224)
+
+    def encode_image(self, images):
+        assert images.shape[1:] == (3, 224, 224)
+        return images.mean(dim=(2, 3))
+
+    def encode_text(self, tokens):
+        return tokens
+
+
+def fake_tokenize(prompts, truncate):
+    return torch.tensor([[float("red" in prompt), float("red" not in prompt), 0.0] for prompt in prompts])
+
+
+def test_safety_checker_checks_images_and_prompts(monkeypatch, tmp_path):
+    monkeypatch.setitem(
+        sys.modules, "clip", types.SimpleNamespace(load=lambda name, device: (FakeCLIP(), None), tokenize=fake_tokenize)
+    )
+    # flags the images whose normalized mean color is close to red
+    torch.save(torch.tensor([[1.0, 0.0, 0.0]]), tmp_path / "safety_embedding.pt")
+    checker = SafetyChecker(tmp_path / "safety_embedding.pt")
+
+    images = torch.zeros((2, 3, 64, 96))
+    images[0, 0] = 1.0
+    images[1, 1] = 1.0
+
+    assert checker(images) == [True, False]
+    assert checker.check_prompts(["something red", "something green"], threshold=0.5) == [True, False]
@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from muse.pipeline.staged import StagedPipeline
+
+
+def test_items_flow_through_the_stages_in_order():
+    pipeline = StagedPipeline([("add", lambda x: x + 1), ("double", lambda x: x * 2)])
+    try:
+        futures = [pipeline.submit(i) for i in range(5)]
+        assert [future.result(timeout=5) for future in futures] == [2, 4, 6, 8, 10]
+        stats = pipeline.stats()
+        assert list(stats) == ["add", "double"]
+        assert stats["add"]["count"] == 5 and stats["double"]["count"] == 5
+    finally:
+        pipeline.stop()
+
+
+def test_stages_overlap():
+    second_started = threading.Event()
+
+    def first(x):
+        if x == 1:
+            # the second stage works on item 0 while the first stage works on item 1
+            assert second_started.wait(timeout=5)
+        return x
+
+    def second(x):
+        second_started.set()
+        time.sleep(0.1)
+        return x
+
+    pipeline = StagedPipeline([("first", first), ("second", second)])
+    try:
+        futures = [pipeline.submit(i) for i in range(2)]
+        assert [future.result(timeout=5) for future in futures] == [0, 1]
+    finally:
+        pipeline.stop()
+
+
+def test_failure_of_a_stage_fails_only_its_item():
+    def fail_on_odd(x):
+        if x % 2:
+            raise ValueError(x)
+        return x
+
+    pipeline = StagedPipeline([("check", fail_on_odd), ("identity", lambda x: x)])
+    try:
+        futures = [pipeline.submit(i) for i in range(3)]
+        assert futures[0].result(timeout=5) == 0
+        with pytest.raises(ValueError):
+            futures[1].result(timeout=5)
+        assert futures[2].result(timeout=5) == 2
+    finally:
+        pipeline.stop()
@@ -0,0 +1,125 @@
+import hashlib
+import io
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from muse.utility.weights import ChecksumError, WeightCache
+
+PAYLOAD = bytes(range(256)) * 64
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serves ``files`` with range requests, the first ``drops`` GET responses are cut after ``drop_after`` bytes."""
+
+    files = {}
+    requests = []
+    drops = 0
+    drop_after = 100
+    lock = threading.Lock()
+
+    def do_HEAD(self):
+        self._send(head=True)
+
+    def do_GET(self):
+        self._send(head=False)
+
+    def _send(self, head: bool):
+        body = self.files[self.path]
+        start, end = 0, len(body) - 1
+        range_header = self.headers.get("Range")
+        if range_header:
+            first, last = range_header.split("=")[1].split("-")
+            start, end = int(first), int(last) if last else len(body) - 1
+        self.send_response(206 if range_header else 200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+        if head:
+            return
+        with self.lock:
+            type(self).requests.append(range_header)
+            drop = type(self).drops > 0
+            type(self).drops -= drop
+        data = body[start : end + 1]
+        self.wfile.write(data[: self.drop_after] if drop else data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server():
+    FileHandler.files, FileHandler.requests, FileHandler.drops = {}, [], 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_large_file_is_fetched_in_parallel_ranges_once(server, tmp_path):
+    FileHandler.files["/model.ckpt"] = PAYLOAD
+    cache = WeightCache(tmp_path, num_connections=4, min_part_bytes=1024)
+
+    blob = cache.fetch(f"{server}/model.ckpt", sha256=hashlib.sha256(PAYLOAD).hexdigest())
+    again = WeightCache(tmp_path).fetch(f"{server}/model.ckpt")
+
+    assert blob == again and blob.read_bytes() == PAYLOAD
+    assert set(FileHandler.requests) == {f"bytes={i * 4096}-{i * 4096 + 4095}" for i in range(4)}
+
+
+def test_interrupted_downloads_resume(server, tmp_path):
+    FileHandler.files["/model.ckpt"] = PAYLOAD
+    FileHandler.files["/small.ckpt"] = PAYLOAD[:1000]
+    FileHandler.drops = 2
+    cache = WeightCache(tmp_path, num_connections=1, min_part_bytes=1024, max_attempts=3, timeout=5)
+
+    assert cache.fetch(f"{server}/model.ckpt").read_bytes() == PAYLOAD
+    # every retry asks for the bytes after the ones already written
+    assert FileHandler.requests == ["bytes=0-16383", "bytes=100-16383", "bytes=200-16383"]
+
+    FileHandler.requests, FileHandler.drops = [], 1
+    assert cache.fetch(f"{server}/small.ckpt").read_bytes() == PAYLOAD[:1000]
+    assert FileHandler.requests == [None, "bytes=100-"]
+
+
+def test_progress_is_saved_on_an_interval(server, tmp_path, monkeypatch):
+    FileHandler.files["/model.ckpt"] = PAYLOAD
+    monkeypatch.setattr("muse.utility.weights.CHUNK_BYTES", 1024)
+    saves = []
+    monkeypatch.setattr(WeightCache, "_save_progress", lambda self, part, size, bounds, done: saves.append(list(done)))
+    cache = WeightCache(tmp_path, num_connections=2, min_part_bytes=1024, progress_interval=60)
+
+    assert cache.fetch(f"{server}/model.ckpt").read_bytes() == PAYLOAD
+    # 16 chunks, but the progress is only saved when each of the 2 range requests ends
+    assert len(saves) == 2 and saves[-1] == [8192, 8192]
+
+
+def test_checksum_mismatch_is_discarded(server, tmp_path):
+    FileHandler.files["/model.ckpt"] = PAYLOAD
+    cache = WeightCache(tmp_path, min_part_bytes=1024)
+
+    with pytest.raises(ChecksumError):
+        cache.fetch(f"{server}/model.ckpt", sha256="0" * 64)
+    assert list((tmp_path / "blobs").iterdir()) == []
+    assert list((tmp_path / "partial").iterdir()) == []
+
+
+def test_archive_is_extracted_while_downloading(server, tmp_path):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        info = tarfile.TarInfo("weights/model.ckpt")
+        info.size = len(PAYLOAD)
+        archive.addfile(info, io.BytesIO(PAYLOAD))
+    FileHandler.files["/weights.tar.gz"] = buffer.getvalue()
+    cache = WeightCache(tmp_path / "cache")
+
+    cache.fetch(f"{server}/weights.tar.gz", extract_to=tmp_path / "first")
+    cache.fetch(f"{server}/weights.tar.gz", extract_to=tmp_path / "second")
+
+    assert (tmp_path / "first" / "weights" / "model.ckpt").read_bytes() == PAYLOAD
+    assert (tmp_path / "second" / "weights" / "model.ckpt").read_bytes() == PAYLOAD
+    assert FileHandler.requests == [None]